@@ -1,10 +1,54 @@
+from django.conf import settings
 from django.conf.urls.defaults import *
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from django import forms
 from django.http import HttpResponseRedirect
 from .models import Message
-from .router import get_router
+from .router import get_router, HttpRouter
+from .replicas import use_replica
+
+class CappedCountQuerySet(QuerySet):
+    """
+    QuerySet which stops counting once it gets past ROUTER_ADMIN_COUNT_LIMIT rows.  Counting every
+    message on large tables is slow and the exact number isn't very useful in the changelist.
+    """
+    def count(self):
+        limit = getattr(settings, 'ROUTER_ADMIN_COUNT_LIMIT', 10000)
+        if self._result_cache is not None or not limit:
+            return super(CappedCountQuerySet, self).count()
+
+        # count over a limited subquery of ids, so the database can stop scanning early
+        sql, params = self.values('pk')[:limit].query.get_compiler(using=self.db).as_sql()
+        cursor = connections[self.db].cursor()
+        cursor.execute("SELECT COUNT(*) FROM (%s) capped" % sql, params)
+        return cursor.fetchone()[0]
+
+class MessageChangeList(ChangeList):
+    """
+    ChangeList which searches phone numbers by the start of their normalized identity, so numbers
+    can be found however they are typed, using the identity index rather than scanning every one.
+    """
+    def get_query_set(self, request):
+        # let our parent do everything but the search, which we do ourselves
+        query, self.query = self.query, ''
+        try:
+            queryset = super(MessageChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+
+        if query:
+            search = Q(text__icontains=query)
+            identity = HttpRouter.normalize_number(query)
+            if identity:
+                search |= Q(connection__identity__startswith=identity)
+            queryset = queryset.filter(search)
+
+        return queryset
 
 class MessageAdmin(admin.ModelAdmin):
 
@@ -31,8 +75,18 @@ class MessageAdmin(admin.ModelAdmin):
         if not extra_context:
             extra_context = dict()
         extra_context['title'] = "Messages"
-        
-        return super(MessageAdmin, self).changelist_view(request, extra_context)
+
+        # the changelist only reads messages, so it can come from our replica
+        with use_replica():
+            return super(MessageAdmin, self).changelist_view(request, extra_context)
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
+    def queryset(self, request):
+        # we display the identity and backend of every message, so load them in the same query
+        queryset = super(MessageAdmin, self).queryset(request).select_related('connection__backend')
+        return queryset._clone(klass=CappedCountQuerySet)
 
     def identity(self, obj):
         return "<a href='?connection=%s&q=%s'>%s</a>" % (obj.connection.id, obj.connection.identity, obj.connection.identity)
@@ -53,6 +107,8 @@ class MessageAdmin(admin.ModelAdmin):
     list_display_links = ('text',)
 
     actions = None
+
+    # searched by MessageChangeList, phone numbers are matched by their normalized prefix
     search_fields = ('connection__identity', 'text')
 
     change_list_template = "router/admin/change_list.html"
@@ -0,0 +1,190 @@
+"""
+Admission control for incoming messages.
+
+When the database or our SMS apps slow down, every request to /router/receive ties up a web worker
+for longer, until none are left and backends start timing out and retrying.  To avoid this the
+router keeps track of how many messages are being handled, both overall and per backend, along
+with how long they are taking.  Once over the configured limits, new messages are either rejected
+with a 503 and a Retry-After header, or saved and handed off to Celery to be handled later.  The
+following settings control this, all are optional:
+
+    ROUTER_MAX_IN_FLIGHT = 20                   # messages handled at once
+    ROUTER_MAX_IN_FLIGHT_PER_BACKEND = 10       # or a dict by backend name, with an optional 'default'
+    ROUTER_MAX_LATENCY = 5                      # above this average, messages are handled one at a time
+    ROUTER_OVERLOAD_ACTION = 'reject'           # or 'queue'
+    ROUTER_RETRY_AFTER = 30                     # the Retry-After given to rejected requests
+    ROUTER_ADMISSION_BACKEND = 'redis'          # count messages across all processes
+
+By default messages are counted in each process, which only limits threaded servers running a
+single process.  With pre-forking or other multi-process servers, each process only ever handles
+one message at a time, so set ROUTER_ADMISSION_BACKEND to 'redis' to count messages across all of
+them.  Each slot in Redis expires ROUTER_ADMISSION_TTL seconds (60 by default) after it was taken,
+so slots held by processes which died are given back even while traffic keeps arriving.
+"""
+from django.conf import settings
+
+from contextlib import contextmanager
+from threading import Lock
+import time
+import uuid
+
+from .utils import get_redis
+
+# the redis keys we keep our slots, counts and average latency in, slots are sorted sets of tokens
+# scored by when they expire
+ADMISSION_KEY = 'router_admission:%s'
+
+# how much weight we give each new sample in our average latency
+LATENCY_WEIGHT = 0.2
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.in_flight = 0
+        self.in_flight_by_backend = dict()
+        self.latency = 0.0
+        self.rejected = 0
+
+    def use_redis(self):
+        return getattr(settings, 'ROUTER_ADMISSION_BACKEND', 'local') == 'redis'
+
+    def get_ttl(self):
+        return getattr(settings, 'ROUTER_ADMISSION_TTL', 60)
+
+    def get_backend_limit(self, backend):
+        limit = getattr(settings, 'ROUTER_MAX_IN_FLIGHT_PER_BACKEND', None)
+        if isinstance(limit, dict):
+            return limit.get(backend, limit.get('default', None))
+        return limit
+
+    def get_latency(self):
+        if self.use_redis():
+            return float(get_redis().get(ADMISSION_KEY % 'latency') or 0)
+        return self.latency
+
+    def get_limit(self):
+        limit = getattr(settings, 'ROUTER_MAX_IN_FLIGHT', None)
+
+        # when we are running slowly, only handle one message at a time until we catch up
+        max_latency = getattr(settings, 'ROUTER_MAX_LATENCY', None)
+        if max_latency and self.get_latency() > max_latency:
+            return 1
+
+        return limit
+
+    def admit(self, backend):
+        """
+        Returns whether we can handle a message on the passed in backend right now, reserving a slot
+        for it if so.  Slots must be released once the message has been handled, passing back the
+        value returned here.
+        """
+        limit = self.get_limit()
+        backend_limit = self.get_backend_limit(backend)
+
+        if self.use_redis():
+            return self.admit_redis(backend, limit, backend_limit)
+
+        with self.lock:
+            backend_in_flight = self.in_flight_by_backend.get(backend, 0)
+
+            if (limit and self.in_flight >= limit) or (backend_limit and backend_in_flight >= backend_limit):
+                self.rejected += 1
+                return False
+
+            self.in_flight += 1
+            self.in_flight_by_backend[backend] = backend_in_flight + 1
+            return True
+
+    def get_slot_keys(self, backend):
+        return ADMISSION_KEY % 'in_flight', ADMISSION_KEY % ('in_flight:%s' % backend)
+
+    def admit_redis(self, backend, limit, backend_limit):
+        r = get_redis()
+        keys = self.get_slot_keys(backend)
+        token = uuid.uuid4().hex
+        now = time.time()
+
+        # drop any slots which expired, then take ours, giving it back if that put us over a limit
+        pipe = r.pipeline()
+        for key in keys:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, now + self.get_ttl(), token)
+            pipe.zcard(key)
+            pipe.expire(key, self.get_ttl())
+        results = pipe.execute()
+        in_flight, backend_in_flight = results[2], results[6]
+
+        if (limit and in_flight > limit) or (backend_limit and backend_in_flight > backend_limit):
+            self.release_slot(r, keys, token)
+            r.incr(ADMISSION_KEY % 'rejected')
+            return False
+
+        return token
+
+    def release_slot(self, r, keys, token):
+        pipe = r.pipeline()
+        for key in keys:
+            pipe.zrem(key, token)
+        pipe.execute()
+
+    def release(self, backend, elapsed, token=None):
+        """
+        Releases the slot for a message on the passed in backend which took elapsed seconds to handle.
+        """
+        if self.use_redis():
+            r = get_redis()
+            self.release_slot(r, self.get_slot_keys(backend), token)
+
+            # our average is shared by all our processes, a lost update now and then doesn't matter
+            latency = self.get_latency()
+            r.set(ADMISSION_KEY % 'latency', latency + (elapsed - latency) * LATENCY_WEIGHT, ex=self.get_ttl())
+            return
+
+        with self.lock:
+            self.in_flight -= 1
+            self.in_flight_by_backend[backend] -= 1
+            if not self.in_flight_by_backend[backend]:
+                del self.in_flight_by_backend[backend]
+
+            self.latency += (elapsed - self.latency) * LATENCY_WEIGHT
+
+    @contextmanager
+    def slot(self, backend):
+        """
+        Context manager which holds a slot for a message on the passed in backend while it is being
+        handled, raising Overloaded if we have no room for it.
+        """
+        token = self.admit(backend)
+        if not token:
+            raise Overloaded("Too many messages in flight for backend '%s'" % backend)
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(backend, time.time() - start, token)
+
+    def should_queue(self):
+        return getattr(settings, 'ROUTER_OVERLOAD_ACTION', 'reject') == 'queue'
+
+    def get_retry_after(self):
+        return getattr(settings, 'ROUTER_RETRY_AFTER', 30)
+
+    def stats(self):
+        if self.use_redis():
+            r = get_redis()
+            key = ADMISSION_KEY % 'in_flight'
+            pipe = r.pipeline()
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.zcard(key)
+            pipe.get(ADMISSION_KEY % 'rejected')
+            removed, in_flight, rejected = pipe.execute()
+            return dict(in_flight=in_flight, latency=round(self.get_latency(), 3), rejected=int(rejected or 0))
+
+        return dict(in_flight=self.in_flight, latency=round(self.latency, 3), rejected=self.rejected)
@@ -0,0 +1,204 @@
+"""
+Query budgets for the router's hot paths.
+
+Every path a message takes through the router has a maximum number of SQL queries it should make,
+declared in QUERY_BUDGETS below.  Budgets are either a fixed number of queries, or a tuple of
+(base, per item) where the caller says how many items (responses, messages..) it handled.
+
+Paths which run the same queries on every shard, listed in SHARDED_BUDGETS, have their budgets
+multiplied by the number of ROUTER_SHARDS.
+
+When ROUTER_QUERY_BUDGET_WARNINGS is set (it defaults to DEBUG) the router counts the queries it
+makes on these paths and warns whenever a budget is exceeded.  The savepoints apps are called within
+don't count against budgets.  Tests can assert budgets using the
+QueryBudgetTestMixin.
+"""
+from django.conf import settings
+
+from functools import wraps
+from threading import local
+import logging
+import warnings
+
+from .sharding import get_shards
+from .utils import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+# our default budgets, these can be overridden using ROUTER_QUERY_BUDGETS in your settings.py
+QUERY_BUDGETS = {
+    # connection with its backend and contact, backend and connection creation for new senders,
+    # message creation and status update, plus message creation and status update for each response
+    'handle_incoming': (5, 2),
+
+    # message creation, connection backend for logging and status update
+    'add_outgoing': 3,
+
+    # loading the message with its connection and backend, then saving its new status, failures
+    # also count previous errors and record a new one
+    'send_message': 4,
+
+    # a single query for every check of the outbox
+    'outbox': 1,
+
+    # loading and updating the message
+    'delivered': 2,
+
+    # a single update for each TextIt status event
+    'textit_status': 1,
+}
+
+# the budgets of paths which query every shard, these are per shard
+SHARDED_BUDGETS = ('outbox', 'textit_status')
+
+
+# the budgets being counted by our current thread
+_budgets = local()
+
+
+class QueryBudgetWarning(RuntimeWarning):
+    pass
+
+
+def get_query_budget(name, items=0):
+    """
+    Returns the maximum number of queries allowed for the passed in budget and number of items.
+    """
+    budget = getattr(settings, 'ROUTER_QUERY_BUDGETS', {}).get(name, QUERY_BUDGETS[name])
+    if isinstance(budget, tuple):
+        base, per_item = budget
+        budget = base + per_item * items
+
+    if name in SHARDED_BUDGETS:
+        budget *= len(get_shards()) or 1
+
+    return budget
+
+
+def budget_warnings_enabled():
+    return getattr(settings, 'ROUTER_QUERY_BUDGET_WARNINGS', getattr(settings, 'DEBUG', False))
+
+
+class query_budget(object):
+    """
+    Counts the queries made within a block or function, warning if they exceed the named budget.
+    This is a noop unless budget warnings are enabled.  Used either as a decorator:
+
+        @query_budget('add_outgoing')
+        def add_outgoing(self, connection, text, source=None, status='Q'):
+
+    Or as a context manager, optionally setting the number of items handled within the block and
+    excluding queries which are out of our control, such as those made by SMS apps:
+
+        with query_budget('handle_incoming') as budget:
+            with budget.exclude():
+                self.process_incoming_phases(msg)
+            ...
+            budget.items = len(responses)
+    """
+    def __init__(self, name, items=0):
+        self.name = name
+        self.items = items
+        self.excluded = 0
+        self.excluding = 0
+        self.counter = None
+
+    def exclude(self):
+        return ExcludedQueries(self)
+
+    def __enter__(self):
+        if budget_warnings_enabled():
+            self.counter = QueryCounter().__enter__()
+            _budgets.active = getattr(_budgets, 'active', []) + [self]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.counter:
+            _budgets.active = [budget for budget in _budgets.active if budget is not self]
+            self.counter.__exit__(exc_type, exc_value, traceback)
+            self.counter, counter = None, self.counter
+
+            count = counter.count - self.excluded
+            budget = get_query_budget(self.name, self.items)
+            if count > budget:
+                message = "%s made %d queries, over its budget of %d" % (self.name, count, budget)
+                logger.warning(message)
+                warnings.warn(message, QueryBudgetWarning)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with query_budget(self.name, self.items):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class ExcludedQueries(object):
+    """
+    Context manager for queries which shouldn't count against a budget.  Exclusions can be nested,
+    queries are only excluded once.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+
+    def __enter__(self):
+        if self.budget.counter:
+            self.budget.excluding += 1
+            if self.budget.excluding == 1:
+                self.start = len(self.budget.counter.get_queries())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.budget.counter:
+            self.budget.excluding -= 1
+            if not self.budget.excluding:
+                self.budget.excluded += len(self.budget.counter.get_queries()) - self.start
+
+
+class exclude_queries(object):
+    """
+    Excludes the queries made within a block from every budget our thread is counting, used for
+    queries we make on behalf of apps, such as their savepoints.
+    """
+    def __enter__(self):
+        self.exclusions = [budget.exclude() for budget in getattr(_budgets, 'active', [])]
+        for exclusion in self.exclusions:
+            exclusion.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for exclusion in reversed(self.exclusions):
+            exclusion.__exit__(exc_type, exc_value, traceback)
+
+
+class QueryBudgetTestMixin(object):
+    """
+    Mixin for TestCases which lets you assert that a block of code stays within a query budget:
+
+        with self.assertQueryBudget('handle_incoming', items=1):
+            router.handle_incoming('test', '250788123123', 'hello')
+    """
+    def assertQueryBudget(self, name, items=0):
+        return AssertQueryBudget(self, name, items)
+
+
+class AssertQueryBudget(object):
+
+    def __init__(self, test_case, name, items):
+        self.test_case = test_case
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.counter = QueryCounter().__enter__()
+        return self.counter
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.counter.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+
+        budget = get_query_budget(self.name, self.items)
+        self.test_case.assertTrue(self.counter.count <= budget,
+                                  "%s made %d queries, over its budget of %d:\n%s" %
+                                  (self.name, self.counter.count, budget,
+                                   "\n".join(q['sql'] for q in self.counter.queries)))
@@ -0,0 +1,163 @@
+"""
+Per-backend circuit breakers for sending messages.
+
+When a backend's endpoint is down, every message sent to it waits out its timeout, records a
+delivery error and uses up one of its retries, all while keeping a worker busy.  When
+ROUTER_CIRCUIT_FAILURES is set, a backend's circuit opens after that many consecutive failed sends,
+counting server and connection errors but not messages the backend refused:
+
+    ROUTER_CIRCUIT_FAILURES = 5         # consecutive failures before a backend's circuit opens
+    ROUTER_CIRCUIT_RESET = 60           # seconds a circuit stays open before we try again
+    ROUTER_CIRCUIT_BACKEND = 'redis'    # share circuits between workers, defaults to 'local'
+
+While a circuit is open, messages for its backend are parked as queued without being attempted or
+counted as a retry, to be picked up again by the resend task.  Once ROUTER_CIRCUIT_RESET seconds have
+passed the circuit is half-open, a single message is sent as a probe, and the circuit closes again if
+it succeeds or stays open for another ROUTER_CIRCUIT_RESET seconds if it doesn't.
+
+Circuits are kept in process by default, which suits a single worker.  If you run more than one, set
+ROUTER_CIRCUIT_BACKEND to 'redis' so that they trip and probe together.
+"""
+from django.conf import settings
+
+from threading import Lock
+import logging
+import time
+
+from .utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# the redis keys we keep each backend's consecutive failures, open circuit and probe claim in
+CIRCUIT_KEY = 'router_circuit:%s:%s'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.circuits = {}
+
+    def get_failures(self):
+        return getattr(settings, 'ROUTER_CIRCUIT_FAILURES', None)
+
+    def get_reset(self):
+        return getattr(settings, 'ROUTER_CIRCUIT_RESET', 60)
+
+    def use_redis(self):
+        return getattr(settings, 'ROUTER_CIRCUIT_BACKEND', 'local') == 'redis'
+
+    def get_circuit(self, backend):
+        return self.circuits.setdefault(backend, dict(failures=0, open_until=0, probe_until=0))
+
+    def get_state(self, backend):
+        threshold = self.get_failures()
+        if not threshold:
+            return CLOSED
+
+        if self.use_redis():
+            r = get_redis()
+            failures, is_open = r.mget([CIRCUIT_KEY % (backend, 'failures'), CIRCUIT_KEY % (backend, 'open')])
+            failures = int(failures or 0)
+        else:
+            with self.lock:
+                circuit = self.get_circuit(backend)
+                failures, is_open = circuit['failures'], circuit['open_until'] > time.time()
+
+        if failures < threshold:
+            return CLOSED
+        return OPEN if is_open else HALF_OPEN
+
+    def allow(self, backend):
+        """
+        Returns whether a message should be sent to the passed in backend.  When its circuit is
+        half-open, only the first caller is allowed through to probe it.
+        """
+        threshold = self.get_failures()
+        if not threshold:
+            return True
+
+        state = self.get_state(backend)
+        if state == CLOSED:
+            return True
+        elif state == OPEN:
+            return False
+
+        # half-open, claim the probe, which lapses after our reset in case its sender never reports back
+        if self.use_redis():
+            return bool(get_redis().set(CIRCUIT_KEY % (backend, 'probe'), '1', ex=self.get_reset(), nx=True))
+
+        with self.lock:
+            circuit = self.get_circuit(backend)
+            now = time.time()
+            if circuit['probe_until'] > now:
+                return False
+            circuit['probe_until'] = now + self.get_reset()
+            return True
+
+    def record_success(self, backend):
+        threshold = self.get_failures()
+        if not threshold:
+            return
+
+        if self.use_redis():
+            r = get_redis()
+            failures = int(r.get(CIRCUIT_KEY % (backend, 'failures')) or 0)
+            if failures:
+                r.delete(*[CIRCUIT_KEY % (backend, key) for key in ('failures', 'open', 'probe')])
+        else:
+            with self.lock:
+                circuit = self.get_circuit(backend)
+                failures = circuit['failures']
+                circuit.update(failures=0, open_until=0, probe_until=0)
+
+        if failures >= threshold:
+            logger.warning("Circuit for backend %s closed" % backend)
+
+    def record_failure(self, backend):
+        threshold = self.get_failures()
+        if not threshold:
+            return
+
+        reset = self.get_reset()
+        if self.use_redis():
+            r = get_redis()
+            failures = r.incr(CIRCUIT_KEY % (backend, 'failures'))
+            if failures >= threshold:
+                r.set(CIRCUIT_KEY % (backend, 'open'), '1', ex=reset)
+                r.delete(CIRCUIT_KEY % (backend, 'probe'))
+        else:
+            with self.lock:
+                circuit = self.get_circuit(backend)
+                circuit['failures'] += 1
+                failures = circuit['failures']
+                if failures >= threshold:
+                    circuit.update(open_until=time.time() + reset, probe_until=0)
+
+        if failures >= threshold:
+            logger.warning("Circuit for backend %s open after %d consecutive failures, retrying in %ds" %
+                           (backend, failures, reset))
+
+    def stats(self):
+        """
+        Returns the backends whose circuits aren't closed.
+        """
+        if not self.get_failures():
+            return dict(open=[])
+
+        if self.use_redis():
+            backends = [key[len('router_circuit:'):-len(':failures')] for key in
+                        get_redis().scan_iter(match=CIRCUIT_KEY % ('*', 'failures'))]
+        else:
+            with self.lock:
+                backends = list(self.circuits.keys())
+
+        return dict(open=sorted(backend for backend in backends if self.get_state(backend) != CLOSED))
+
+
+# the circuit breaker our workers share
+breaker = CircuitBreaker()
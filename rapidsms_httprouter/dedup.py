@@ -0,0 +1,76 @@
+"""
+Deduplication of incoming messages.
+
+Kannel and TextIt retry their requests when we take too long to respond, which without this would
+create a new message and run every app again for each retry.  When ROUTER_DEDUP_WINDOW is set, we
+remember every incoming message for that many seconds, keyed by its backend, sender, text and the
+id assigned to it upstream if there is one.  Any repeats within that window are not handled again,
+instead the original message is returned.
+
+Seen messages are kept in an in-process LRU cache of ROUTER_DEDUP_CACHE_SIZE messages.  If you run
+more than one process, set ROUTER_DEDUP_BACKEND to 'redis' so that they share what they've seen.
+"""
+from django.conf import settings
+
+import hashlib
+
+from .utils import LRUCache, get_redis
+
+# the value we keep for messages which are still being handled
+PENDING = 'pending'
+
+# the redis key we keep each seen message in
+DEDUP_KEY = 'router_dedup:%s'
+
+
+class DuplicateFilter(object):
+
+    def __init__(self):
+        self.cache = LRUCache(getattr(settings, 'ROUTER_DEDUP_CACHE_SIZE', 10000))
+
+    def get_window(self):
+        return getattr(settings, 'ROUTER_DEDUP_WINDOW', 0)
+
+    def use_redis(self):
+        return getattr(settings, 'ROUTER_DEDUP_BACKEND', 'local') == 'redis'
+
+    def get_key(self, backend, sender, text, external_id=None):
+        from .router import HttpRouter
+
+        text_hash = hashlib.sha1(unicode(text).encode('utf-8')).hexdigest()
+        return "%s:%s:%s:%s" % (backend, HttpRouter.normalize_number(sender), text_hash, external_id or '')
+
+    def claim(self, key):
+        """
+        Tries to claim the passed in key for a new message.  Returns None if we claimed it, otherwise
+        returns either the id of the original message, or PENDING if it is still being handled.
+        """
+        window = self.get_window()
+
+        if self.use_redis():
+            r = get_redis()
+            if r.set(DEDUP_KEY % key, PENDING, ex=window, nx=True):
+                return None
+            return r.get(DEDUP_KEY % key) or PENDING
+
+        if self.cache.add(key, PENDING, ttl=window):
+            return None
+        return self.cache.get(key, PENDING)
+
+    def complete(self, key, message_id):
+        """
+        Records the id of the message created for the passed in key.
+        """
+        if self.use_redis():
+            get_redis().set(DEDUP_KEY % key, str(message_id), ex=self.get_window())
+        else:
+            self.cache.set(key, str(message_id), ttl=self.get_window())
+
+    def release(self, key):
+        """
+        Releases our claim on the passed in key, used when handling the message failed.
+        """
+        if self.use_redis():
+            get_redis().delete(DEDUP_KEY % key)
+        else:
+            self.cache.delete(key)
@@ -0,0 +1,132 @@
+"""
+Load balancing and failover across the endpoints of a backend.
+
+Each backend in ROUTER_URL can be given a list of endpoints instead of a single URL, optionally
+with weights, in which case messages are spread across them:
+
+    ROUTER_URL = {
+        'mtn': [('http://kannel1:13013/cgi-bin/sendsms?to=%(recipient)s&text=%(text)s&id=%(id)s', 2),
+                ('http://kannel2:13013/cgi-bin/sendsms?to=%(recipient)s&text=%(text)s&id=%(id)s', 1)],
+        'default': 'http://kannel3:13013/cgi-bin/sendsms?to=%(recipient)s&text=%(text)s&id=%(id)s',
+    }
+    ROUTER_ENDPOINT_STRATEGY = 'least_outstanding'  # or 'weighted', for weighted round robin
+    ROUTER_ENDPOINT_COOLDOWN = 30                   # seconds an endpoint sits out after an error
+
+With 'least_outstanding' each send goes to the endpoint with the fewest requests in flight for its
+weight, falling back to weighted round robin between endpoints which are equally busy.  Endpoints
+which error are skipped for ROUTER_ENDPOINT_COOLDOWN seconds and the message is tried on the next
+endpoint straight away, so it's only errored once every endpoint has failed, or once trying another
+could run past the lock held on the message while it is sent.  If every endpoint is cooling down,
+they are all tried anyway.
+
+Requests in flight and errors are tracked in each worker, so they only balance requests made by the
+same process, while round robin spreads sends across endpoints regardless.
+"""
+from django.conf import settings
+
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_endpoints(backend):
+    """
+    Returns the URL templates and weights configured in ROUTER_URL for the passed in backend name.
+    """
+    router_url = settings.ROUTER_URL
+
+    # is this actually a dict?  if so, we want to look up the appropriate backend
+    if isinstance(router_url, dict):
+        if backend in router_url:
+            router_url = router_url[backend]
+        elif 'default' in router_url:
+            router_url = router_url['default']
+        else:
+            raise Exception("No router url mapping found for backend '%s', check your settings.ROUTER_URL setting" % backend)
+
+    if not isinstance(router_url, (list, tuple)):
+        return [(router_url, 1)]
+
+    endpoints = []
+    for endpoint in router_url:
+        if isinstance(endpoint, (list, tuple)):
+            endpoints.append((endpoint[0], endpoint[1]))
+        else:
+            endpoints.append((endpoint, 1))
+    return endpoints
+
+
+class EndpointPool(object):
+    """
+    Chooses the endpoint each message is sent to, keeping track of requests in flight to each and
+    which have recently failed.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.outstanding = defaultdict(int)
+        self.current = defaultdict(int)
+        self.down_until = {}
+
+    def get_strategy(self):
+        return getattr(settings, 'ROUTER_ENDPOINT_STRATEGY', 'least_outstanding')
+
+    def get_cooldown(self):
+        return getattr(settings, 'ROUTER_ENDPOINT_COOLDOWN', 30)
+
+    def is_healthy(self, url):
+        return self.down_until.get(url, 0) <= time.time()
+
+    def choose(self, backend, exclude=()):
+        """
+        Returns the URL template the next message for the passed in backend should be sent to,
+        skipping any in exclude, or None if there are none left.
+        """
+        endpoints = [(url, weight) for url, weight in get_endpoints(backend) if url not in exclude]
+        if len(endpoints) <= 1:
+            return endpoints[0][0] if endpoints else None
+
+        with self.lock:
+            endpoints = [endpoint for endpoint in endpoints if self.is_healthy(endpoint[0])] or endpoints
+
+            if self.get_strategy() == 'least_outstanding':
+                load = lambda endpoint: self.outstanding[endpoint[0]] / float(endpoint[1])
+                least = min(load(endpoint) for endpoint in endpoints)
+                endpoints = [endpoint for endpoint in endpoints if load(endpoint) == least]
+
+            # smooth weighted round robin, each endpoint earns its weight and the richest is chosen
+            for url, weight in endpoints:
+                self.current[url] += weight
+            url = max(endpoints, key=lambda endpoint: self.current[endpoint[0]])[0]
+            self.current[url] -= sum(weight for url, weight in endpoints)
+
+        return url
+
+    @contextmanager
+    def sending(self, url):
+        with self.lock:
+            self.outstanding[url] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.outstanding[url] -= 1
+
+    def mark_failed(self, url):
+        cooldown = self.get_cooldown()
+        with self.lock:
+            self.down_until[url] = time.time() + cooldown
+
+        logger.warning("Endpoint %s failed, skipping it for %ds" % (url.split('?')[0], cooldown))
+
+    def mark_ok(self, url):
+        if url in self.down_until:
+            with self.lock:
+                self.down_until.pop(url, None)
+
+
+# the endpoints our workers send through
+endpoints = EndpointPool()
@@ -0,0 +1,198 @@
+"""
+Bulk exports of messages, used by the exportmessages management command.
+
+Messages are read in chunks by id from our read replica if we have one, and written out as they
+are read, so exports of any size run in constant memory without holding long running queries or
+locks on the primary.  When sharding, each shard is exported in turn.  After every chunk the id of
+the last message written from each shard is saved alongside the export, so an interrupted export
+can be resumed where it left off.  Message dates aren't indexed, so exports from a start date
+begin at the id found by a binary search on id rather than scanning from the first message.
+"""
+from .models import Message
+from .replicas import use_replica
+from .sharding import get_shards, use_shard
+from .utils import iterate_chunks, get_id_before
+
+from cStringIO import StringIO
+import csv
+import gzip
+import json
+import os
+import time
+
+# the fields we read for each message, the first must be its id
+EXPORT_FIELDS = ('pk', 'direction', 'status', 'connection__backend__name', 'connection__identity', 'text',
+                 'priority', 'in_response_to', 'external_id', 'date', 'updated', 'sent', 'delivered')
+
+# the columns we write for each message, in the same order
+EXPORT_COLUMNS = ('id', 'direction', 'status', 'backend', 'identity', 'text',
+                  'priority', 'in_response_to', 'external_id', 'date', 'updated', 'sent', 'delivered')
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+def get_progress_path(path):
+    return path + '.progress'
+
+
+def read_progress(path):
+    """
+    Returns the size of the export at path when it last recorded its progress and the id of the
+    last message written from each shard, or zero and no ids if there is no export to resume.
+    """
+    progress_path = get_progress_path(path)
+    if not os.path.exists(path) or not os.path.exists(progress_path):
+        return 0, []
+
+    with open(progress_path) as progress:
+        values = [int(value) for value in progress.read().split()]
+        return values[0], values[1:]
+
+
+def write_progress(path, size, last_ids):
+    progress_path = get_progress_path(path)
+    with open(progress_path + '.tmp', 'w') as progress:
+        progress.write("%d %s\n" % (size, " ".join(str(last_id) for last_id in last_ids)))
+
+    # replace our previous progress in one step, so it's never left half written
+    os.rename(progress_path + '.tmp', progress_path)
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    elif hasattr(value, 'isoformat'):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class MessageExport(object):
+    """
+    Writes the messages matching the passed in filters to a file as CSV or newline delimited JSON,
+    gzipped if the file name ends in .gz, ie:
+
+        count = MessageExport(start=start, backends=['mtn'], direction='I').write('mtn.csv.gz')
+    """
+    def __init__(self, start=None, end=None, backends=None, direction=None, statuses=None, format='csv',
+                 chunk_size=1000, pause=0):
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Unknown format '%s'" % format)
+
+        self.start = start
+        self.end = end
+        self.backends = backends
+        self.direction = direction
+        self.statuses = statuses
+        self.format = format
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def get_queryset(self):
+        messages = Message.objects.all()
+        if self.start:
+            messages = messages.filter(date__gte=self.start)
+        if self.end:
+            messages = messages.filter(date__lt=self.end, pk__lte=get_id_before(Message, 'date', self.end))
+        if self.backends:
+            messages = messages.filter(connection__backend__name__in=self.backends)
+        if self.direction:
+            messages = messages.filter(direction=self.direction)
+        if self.statuses:
+            messages = messages.filter(status__in=self.statuses)
+        return messages
+
+    def encode(self, rows):
+        """
+        Returns the passed in rows of values encoded in our format.
+        """
+        if self.format == 'csv':
+            data = StringIO()
+            writer = csv.writer(data)
+            for row in rows:
+                writer.writerow([format_value(value) for value in row])
+            return data.getvalue()
+
+        lines = []
+        for row in rows:
+            values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in row]
+            lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, values))) + "\n")
+        return ''.join(lines)
+
+    def write_data(self, out, data, compress):
+        # each chunk is its own gzip member, which readers treat as one continuous stream, so we
+        # can stop and resume after any chunk
+        if compress:
+            member = gzip.GzipFile(fileobj=out, mode='wb')
+            member.write(data)
+            member.close()
+        else:
+            out.write(data)
+
+    def write(self, path, resume=False, progress=None):
+        """
+        Writes our export to the file at path, returning the number of messages written.  If resume
+        is set, the export picks up after the last message it wrote from each shard.  The optional
+        progress callable is called with the running count and last id after every chunk.
+        """
+        size, last_ids = read_progress(path) if resume else (0, [])
+        compress = path.endswith('.gz')
+
+        # starting afresh, forget about any previous export
+        if not size and os.path.exists(get_progress_path(path)):
+            os.remove(get_progress_path(path))
+
+        # we keep track of the last id written from each of our shards
+        shards = get_shards() or [None]
+        last_ids = (last_ids + [0] * len(shards))[:len(shards)]
+
+        count = 0
+        out = open(path, 'r+b' if size else 'wb')
+        try:
+            # drop anything written after our last recorded chunk
+            out.truncate(size)
+            out.seek(size)
+
+            if self.format == 'csv' and not size:
+                self.write_data(out, self.encode([EXPORT_COLUMNS]), compress)
+
+            # export each of our shards in turn
+            for index, shard in enumerate(shards):
+                with use_shard(shard), use_replica():
+                    count += self.write_shard(out, path, last_ids, index, progress, count)
+        finally:
+            out.close()
+
+        return count
+
+    def write_shard(self, out, path, last_ids, index, progress, count):
+        """
+        Writes the messages on our current shard after the last one we exported from it, returning
+        how many were written.  The shard's entry in last_ids is kept up to date as we go.
+        """
+        compress = path.endswith('.gz')
+        written = 0
+
+        # skip straight to our start date
+        start_id = last_ids[index]
+        if self.start:
+            start_id = max(start_id, get_id_before(Message, 'date', self.start))
+
+        for chunk in iterate_chunks(self.get_queryset(), EXPORT_FIELDS, self.chunk_size, start_id=start_id):
+            self.write_data(out, self.encode(chunk), compress)
+            written += len(chunk)
+            last_ids[index] = chunk[-1][0]
+
+            # only record our progress once the chunk has made it out of our buffers
+            out.flush()
+            write_progress(path, out.tell(), last_ids)
+
+            if progress:
+                progress(count + written, last_ids[index])
+
+            # give our database some room to breathe between chunks
+            if self.pause:
+                time.sleep(self.pause)
+
+        return written
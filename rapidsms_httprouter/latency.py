@@ -0,0 +1,109 @@
+"""
+Message lifecycle latency reports, used by the latencyreport management command.
+
+Each message records when it was created, last updated, sent and delivered, which along with the
+message a reply was in response to lets us measure each stage of its life:
+
+    incoming / handled      received to handled by our apps
+    outgoing / reply        the message it responds to being received to the reply being queued
+    outgoing / sent         queued to sent by the backend
+    outgoing / delivered    sent to delivered to the handset
+
+Messages are read in chunks by id and latencies are counted in streaming histograms, so reports
+can be run across very large tables in a single pass using bounded memory.  Message dates aren't
+indexed, so we find the ids our window starts and ends at with a binary search on id first.  When
+sharding, each shard is searched and read in turn.
+
+Messages sent through TextIt are marked sent and delivered when TextIt reports them, which when
+ROUTER_TEXTIT_STATUS_BUFFER is set is when the buffered reports are flushed.
+"""
+from collections import defaultdict
+
+from .models import Message, INCOMING, OUTGOING, HANDLED
+from .replicas import use_replica
+from .sharding import get_shards, use_shard
+from .utils import iterate_chunks, get_id_before, StreamingHistogram
+
+# the fields we read for each message, the first must be its id
+LATENCY_FIELDS = ('pk', 'direction', 'status', 'connection__backend__name', 'date', 'updated', 'sent', 'delivered',
+                  'in_response_to__date')
+
+# the stages we report on, in the order we report them
+LATENCY_STAGES = ((INCOMING, 'handled'), (OUTGOING, 'reply'), (OUTGOING, 'sent'), (OUTGOING, 'delivered'))
+
+# the percentiles we report for each stage
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def seconds(start, end):
+    delta = end - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+
+def get_latencies(direction, status, date, updated, sent, delivered, response_to_date):
+    """
+    Returns the stages and latencies we can measure for a single message.
+    """
+    latencies = []
+
+    if direction == INCOMING:
+        if status == HANDLED and updated:
+            latencies.append(('handled', seconds(date, updated)))
+
+    elif direction == OUTGOING:
+        if response_to_date:
+            latencies.append(('reply', seconds(response_to_date, date)))
+        if sent:
+            latencies.append(('sent', seconds(date, sent)))
+        if sent and delivered:
+            latencies.append(('delivered', seconds(sent, delivered)))
+
+    return latencies
+
+
+class LatencyReport(object):
+    """
+    Calculates latency percentiles for each backend, direction and stage over a window of time, ie:
+
+        rows = LatencyReport(start, end, backends=['mtn']).run()
+    """
+    def __init__(self, start, end, backends=None, chunk_size=1000):
+        self.start = start
+        self.end = end
+        self.backends = backends
+        self.chunk_size = chunk_size
+
+    def get_queryset(self):
+        messages = Message.objects.filter(date__gte=self.start, date__lt=self.end,
+                                          pk__lte=get_id_before(Message, 'date', self.end))
+        if self.backends:
+            messages = messages.filter(connection__backend__name__in=self.backends)
+        return messages
+
+    def run(self):
+        histograms = defaultdict(StreamingHistogram)
+
+        # reports tolerate being a little behind, so they are read from our replica if we have one, when
+        # sharding each shard is read in turn into the same histograms
+        for shard in get_shards() or [None]:
+            with use_shard(shard), use_replica():
+                start_id = get_id_before(Message, 'date', self.start)
+                for chunk in iterate_chunks(self.get_queryset(), LATENCY_FIELDS, self.chunk_size, start_id=start_id):
+                    for pk, direction, status, backend, date, updated, sent, delivered, response_to_date in chunk:
+                        for stage, latency in get_latencies(direction, status, date, updated, sent, delivered,
+                                                            response_to_date):
+                            histograms[(backend, direction, stage)].add(latency)
+
+        order = dict((stage, index) for index, stage in enumerate(LATENCY_STAGES))
+        rows = []
+        for backend, direction, stage in sorted(histograms, key=lambda key: (key[0], order[key[1:]])):
+            histogram = histograms[(backend, direction, stage)]
+
+            row = dict(backend=backend, direction=direction, stage=stage, count=histogram.count,
+                       max=round(histogram.max, 3))
+            for percent in LATENCY_PERCENTILES:
+                row['p%d' % percent] = round(histogram.percentile(percent), 3)
+
+            rows.append(row)
+
+        return rows
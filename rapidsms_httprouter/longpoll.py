@@ -0,0 +1,74 @@
+"""
+Long polling of the outbox.
+
+Relayers which pull their messages from /router/outbox normally poll it on a timer, querying for
+queued messages whether or not anything has changed.  When ROUTER_OUTBOX_MAX_WAIT is set, they can
+instead pass a wait parameter, and if their outbox is empty the request blocks for up to that many
+seconds (capped at ROUTER_OUTBOX_MAX_WAIT) until a message is queued for their backend:
+
+    ROUTER_OUTBOX_MAX_WAIT = 30
+
+    GET /router/outbox?backend=mtn&wait=30
+
+Waiting requests are woken by a Redis pub/sub notification published whenever messages are queued,
+rather than by querying the database again.  Each waiting request holds on to a web worker, so this
+is best served by threaded or evented workers.  Database connections are committed and closed
+while waiting, unless something else such as TransactionMiddleware is managing their transactions.
+"""
+from django.conf import settings
+
+import time
+
+from .utils import get_redis
+
+# the redis channel notifications of newly queued messages are published on, by backend
+OUTBOX_CHANNEL = 'router_outbox:%s'
+
+
+def get_max_wait():
+    return getattr(settings, 'ROUTER_OUTBOX_MAX_WAIT', 0)
+
+
+def notify_outbox(backend):
+    """
+    Wakes up any requests waiting on the outbox of the passed in backend name.
+    """
+    if get_max_wait():
+        get_redis().publish(OUTBOX_CHANNEL % backend.lower(), '1')
+
+
+class OutboxListener(object):
+    """
+    Listens for messages being queued for the passed in backend name, or any backend, ie:
+
+        with OutboxListener('mtn') as listener:
+            if listener.wait(30):
+                ...
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def __enter__(self):
+        self.pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        if self.backend:
+            self.pubsub.subscribe(OUTBOX_CHANNEL % self.backend.lower())
+        else:
+            self.pubsub.psubscribe(OUTBOX_CHANNEL % '*')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pubsub.close()
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for a message to be queued, returning whether one was.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            notification = self.pubsub.get_message(timeout=remaining)
+            if notification and notification['type'] in ('message', 'pmessage'):
+                return True
@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rapidsms_httprouter.router import get_router
+from rapidsms_httprouter.utils import iterate_batches
+
+import csv
+import time
+
+class Command(BaseCommand):
+    args = '<backend> <csv file> <text>'
+    help = 'Sends a message to every phone number in a CSV file, creating messages in bulk.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=500,
+                    help='The number of messages to create at a time'),
+        make_option('--column', action='store', dest='column', type='int', default=0,
+                    help='The column of the CSV file containing phone numbers, starting at 0'),
+        make_option('--skip-header', action='store_true', dest='skip_header', default=False,
+                    help='Skip the first row of the CSV file'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError("Usage: broadcast %s" % self.args)
+
+        backend, filename, text = args
+        column = options['column']
+        batch_size = options['batch_size']
+        router = get_router()
+
+        with open(filename, 'rb') as csv_file:
+            reader = csv.reader(csv_file)
+            if options['skip_header']:
+                next(reader, None)
+
+            # stream our recipients in, skipping any blank rows
+            identities = (row[column].strip() for row in reader if len(row) > column and row[column].strip())
+
+            start = time.time()
+            queued = 0
+            read = 0
+
+            for batch in iterate_batches(identities, batch_size):
+                queued += router.broadcast(backend, batch, text, batch_size=batch_size)
+                read += len(batch)
+
+                elapsed = time.time() - start
+                print "read %d recipients, queued %d messages (%.1f/sec)" % (read, queued, queued / max(elapsed, 0.001))
+
+        print "done, queued %d messages" % queued
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rapidsms_httprouter.bench import capture_traffic
+from rapidsms_httprouter.utils import parse_datetime
+
+import datetime
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = 'Captures the incoming messages received over a window of time to a file, for use with replaytraffic.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', action='store', dest='start', default=None,
+                    help='The start of the window, YYYY-MM-DD [HH:MM[:SS]], defaults to --hours ago'),
+        make_option('--end', action='store', dest='end', default=None,
+                    help='The end of the window, YYYY-MM-DD [HH:MM[:SS]], defaults to now'),
+        make_option('--hours', action='store', dest='hours', type='int', default=24,
+                    help='The length of the window in hours when no start is given'),
+        make_option('--backend', action='append', dest='backends', default=[],
+                    help='Only capture messages on this backend, can be given more than once'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+                    help='The number of messages to read at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: capturetraffic %s" % self.args)
+
+        try:
+            end = parse_datetime(options['end']) if options['end'] else timezone.now()
+            start = parse_datetime(options['start']) if options['start'] else end - datetime.timedelta(hours=options['hours'])
+        except ValueError as e:
+            raise CommandError("%s, use YYYY-MM-DD [HH:MM[:SS]]" % e)
+
+        count = capture_traffic(args[0], start, end, backends=options['backends'], chunk_size=options['chunk_size'])
+        print "captured %d messages from %s to %s" % (count, start, end)
@@ -0,0 +1,72 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rapidsms_httprouter.export import MessageExport, EXPORT_FORMATS, get_progress_path
+from rapidsms_httprouter.utils import parse_datetime
+
+import sys
+
+def parse_date(value):
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        raise CommandError("Invalid date '%s', use YYYY-MM-DD [HH:MM[:SS]]" % value)
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = 'Exports messages with their backend, identity, status and timestamps to a CSV or newline delimited JSON file, ' \
+           'gzipped if the file ends in .gz.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', action='store', dest='start', default=None,
+                    help='Only export messages from this date on, YYYY-MM-DD [HH:MM[:SS]]'),
+        make_option('--end', action='store', dest='end', default=None,
+                    help='Only export messages before this date, YYYY-MM-DD [HH:MM[:SS]]'),
+        make_option('--backend', action='append', dest='backends', default=[],
+                    help='Only export messages on this backend, can be given more than once'),
+        make_option('--direction', action='store', dest='direction', default=None,
+                    help='Only export incoming (I) or outgoing (O) messages'),
+        make_option('--status', action='append', dest='statuses', default=[],
+                    help='Only export messages with this status, can be given more than once'),
+        make_option('--format', action='store', dest='format', default='csv',
+                    help='Export as csv or ndjson'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+                    help='Gzip the export, adding .gz to the file name if needed'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Carry on from where a previous export to the same file left off'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+                    help='The number of messages to read at a time'),
+        make_option('--pause', action='store', dest='pause', type='float', default=0,
+                    help='Seconds to wait between chunks, to go easier on the database'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: exportmessages %s" % self.args)
+
+        if options['format'] not in EXPORT_FORMATS:
+            raise CommandError("Unknown format '%s'" % options['format'])
+
+        if options['direction'] not in (None, 'I', 'O'):
+            raise CommandError("Unknown direction '%s', use I or O" % options['direction'])
+
+        path = args[0]
+        if options['gzip'] and not path.endswith('.gz'):
+            path += '.gz'
+
+        start = parse_date(options['start']) if options['start'] else None
+        end = parse_date(options['end']) if options['end'] else None
+
+        export = MessageExport(start=start, end=end, backends=options['backends'], direction=options['direction'],
+                               statuses=options['statuses'], format=options['format'],
+                               chunk_size=options['chunk_size'], pause=options['pause'])
+
+        def progress(count, last_id):
+            sys.stderr.write("\r%d messages exported, up to id %d" % (count, last_id))
+
+        count = export.write(path, resume=options['resume'], progress=progress)
+        if count:
+            sys.stderr.write("\n")
+
+        print "exported %d messages to %s, progress is kept in %s" % (count, path, get_progress_path(path))
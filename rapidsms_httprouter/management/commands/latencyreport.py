@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rapidsms_httprouter.latency import LatencyReport, LATENCY_PERCENTILES
+from rapidsms_httprouter.utils import parse_datetime
+
+import datetime
+import json
+
+def parse_date(value):
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        raise CommandError("Invalid date '%s', use YYYY-MM-DD [HH:MM[:SS]]" % value)
+
+class Command(BaseCommand):
+    help = 'Reports message latency percentiles in seconds for each backend, direction and stage over a window of time.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', action='store', dest='start', default=None,
+                    help='The start of the window, YYYY-MM-DD [HH:MM[:SS]], defaults to --hours ago'),
+        make_option('--end', action='store', dest='end', default=None,
+                    help='The end of the window, YYYY-MM-DD [HH:MM[:SS]], defaults to now'),
+        make_option('--hours', action='store', dest='hours', type='int', default=24,
+                    help='The length of the window in hours when no start is given'),
+        make_option('--backend', action='append', dest='backends', default=[],
+                    help='Only report on this backend, can be given more than once'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+                    help='The number of messages to read at a time'),
+        make_option('--format', action='store', dest='format', default='table',
+                    help='Output as a table or json'),
+    )
+
+    def handle(self, *args, **options):
+        if options['format'] not in ('table', 'json'):
+            raise CommandError("Unknown format '%s'" % options['format'])
+
+        end = parse_date(options['end']) if options['end'] else timezone.now()
+        start = parse_date(options['start']) if options['start'] else end - datetime.timedelta(hours=options['hours'])
+
+        rows = LatencyReport(start, end, backends=options['backends'], chunk_size=options['chunk_size']).run()
+
+        if options['format'] == 'json':
+            print json.dumps(dict(start=start.isoformat(), end=end.isoformat(), latencies=rows), indent=2)
+            return
+
+        columns = ['backend', 'direction', 'stage', 'count'] + ['p%d' % percent for percent in LATENCY_PERCENTILES] + ['max']
+        lines = [columns] + [[unicode(row[column]) for column in columns] for row in rows]
+        widths = [max(len(line[index]) for line in lines) for index in range(len(columns))]
+
+        print "Latencies in seconds from %s to %s" % (start, end)
+        print
+        for line in lines:
+            print "  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
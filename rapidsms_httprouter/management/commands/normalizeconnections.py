@@ -1,49 +1,124 @@
 from optparse import make_option
 
-from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
 
-from rapidsms.models import Connection, Backend
+from rapidsms.models import Connection
 from rapidsms_httprouter.router import HttpRouter
-from datetime import datetime
+from rapidsms_httprouter.sharding import get_shards
+from rapidsms_httprouter.utils import iterate_chunks
 
-import traceback
+import time
 
 class Command(BaseCommand):
     help = 'Normalizes all connections in the database, removing everything except digits.'
 
-    def handle(self, *files, **options):
-        connection = connections[DEFAULT_DB_ALIAS]
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=1000,
+                    help='The number of connections to normalize in each transaction'),
+        make_option('--start-id', action='store', dest='start_id', type='int', default=0,
+                    help='Only normalize connections with an id greater than this, used to resume'),
+        make_option('--start-shard', action='store', dest='start_shard', default=None,
+                    help='When sharding, the shard to resume on, --start-id only applies to this shard'),
+    )
 
-        # Start transaction management. All fixtures are installed in a
-        # single transaction to ensure that all references are resolved.
-        transaction.commit_unless_managed()
-        transaction.enter_transaction_management()
-        transaction.managed(True)
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
 
-        # for every connection
-        for connection in Connection.objects.all():
-            # try normalizing the number
-            normalized = HttpRouter.normalize_number(connection.identity)
+        # when sharding, every shard has its own connections
+        databases = get_shards() or [router.db_for_write(Connection)]
 
-            # if it is different, then we changed it, first check to see
-            # if there is a connection that is identical.  In that case we don't
-            # change anything, it is too difficult to know who might have a reference
-            # to this connection in the system to remap.
-            if normalized != connection.identity:
-                collision = Connection.objects.filter(identity=normalized, backend=connection.backend)
+        # ids are interleaved across shards, so a start id only means something on the shard it was
+        # printed for, we resume on that shard, skip those before it and walk those after it in full
+        start_index = 0
+        if options.get('start_shard', None):
+            if options['start_shard'] not in databases:
+                raise CommandError("Unknown shard: %s" % options['start_shard'])
+            start_index = databases.index(options['start_shard'])
+        elif len(databases) > 1 and options['start_id']:
+            raise CommandError("--start-shard is required along with --start-id when sharding")
 
-                # no collision!  Ok, we can just save our new identity
-                if not collision:
-                    print "remapping %s to %s" % (connection.identity, normalized)
-                    
-                    connection.identity = normalized
-                    connection.save()
+        start = time.time()
+        processed = 0
+        remapped = 0
+        collisions = 0
 
-                else:
-                    print "skipping %s, collision" % (connection.identity)
+        for index, db in enumerate(databases):
+            if index < start_index:
+                continue
 
-        transaction.commit()
+            # we walk our connections by id, each chunk is normalized and saved in its own transaction
+            start_id = options['start_id'] if index == start_index else 0
+            for chunk in iterate_chunks(Connection.objects.using(db), ('id', 'identity', 'backend'),
+                                        chunk_size=batch_size, start_id=start_id):
+                updates, skipped = self.normalize_chunk(db, chunk)
+                self.update_identities(db, updates)
 
+                processed += len(chunk)
+                remapped += len(updates)
+                collisions += skipped
 
+                elapsed = time.time() - start
+                print "processed %d connections up to id %d on %s, %d remapped, %d collisions (%.1f/sec)" % \
+                      (processed, chunk[-1][0], db, remapped, collisions, processed / max(elapsed, 0.001))
+
+        print "done, %d connections processed, %d remapped, %d skipped due to collisions" % (processed, remapped, collisions)
+
+    def normalize_chunk(self, db, chunk):
+        """
+        Normalizes the identities in the passed in chunk, returning a list of (id, identity) updates
+        that should be applied and the number of connections skipped due to collisions.
+        """
+        changed = []
+        for (id, identity, backend_id) in chunk:
+            normalized = HttpRouter.normalize_number(identity)
+            if normalized != identity:
+                changed.append((id, backend_id, identity, normalized))
+
+        if not changed:
+            return [], 0
+
+        # if there is already a connection with the normalized identity, we don't change anything,
+        # it is too difficult to know who might have a reference to this connection in the system
+        # to remap.  look for all of this chunk's collisions at once
+        existing = Connection.objects.using(db).filter(identity__in=set(c[3] for c in changed),
+                                                       backend__in=set(c[1] for c in changed))
+        taken = set(existing.values_list('backend', 'identity'))
+
+        updates = []
+        skipped = 0
+        for (id, backend_id, identity, normalized) in changed:
+            if (backend_id, normalized) in taken:
+                print "skipping %s, collision" % identity
+                skipped += 1
+            else:
+                print "remapping %s to %s" % (identity, normalized)
+                updates.append((id, normalized))
+
+                # two connections in this chunk could normalize to the same identity
+                taken.add((backend_id, normalized))
+
+        return updates, skipped
+
+    def update_identities(self, db, updates):
+        """
+        Applies the passed in (id, identity) updates in a single statement.
+        """
+        if not updates:
+            return
+
+        connection = connections[db]
+        qn = connection.ops.quote_name
+
+        cases = " ".join(["WHEN %s THEN %s"] * len(updates))
+        sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % \
+              (qn(Connection._meta.db_table), qn('identity'), qn('id'), cases, qn('id'), ", ".join(["%s"] * len(updates)))
+
+        params = []
+        for (id, identity) in updates:
+            params += [id, identity]
+        params += [id for (id, identity) in updates]
+
+        with transaction.commit_on_success(using=db):
+            connection.cursor().execute(sql, params)
+            transaction.set_dirty(using=db)
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rapidsms_httprouter.bench import TrafficReplay
+
+import json
+import os
+import sys
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = 'Replays traffic captured with capturetraffic through the router, outputting results as JSON.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--speed', action='store', dest='speed', type='float', default=1.0,
+                    help='Multiple of the original pace to replay at, 0 for as fast as possible'),
+        make_option('--concurrency', action='store', dest='concurrency', type='int', default=4,
+                    help='The number of messages to handle at once'),
+        make_option('--target', action='store', dest='target', default='receive',
+                    help='Replay through the receive view or directly through the router, one of: %s' % ", ".join(TrafficReplay.targets)),
+        make_option('--backend', action='store', dest='backend', default=None,
+                    help='Replay every message on this backend instead of the one it was captured on'),
+        make_option('--limit', action='store', dest='limit', type='int', default=None,
+                    help='Only replay this many messages'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: replaytraffic %s" % self.args)
+
+        if options['target'] not in TrafficReplay.targets:
+            raise CommandError("Unknown target '%s'" % options['target'])
+
+        if options['concurrency'] < 1 or options['speed'] < 0:
+            raise CommandError("Concurrency must be at least 1 and speed can't be negative")
+
+        replay = TrafficReplay(args[0], speed=options['speed'], concurrency=options['concurrency'],
+                               target=options['target'], backend=options['backend'], limit=options['limit'])
+
+        # our send path logs to stdout, keep that out of our results
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result = replay.run()
+        finally:
+            sys.stdout = stdout
+
+        print json.dumps(result, indent=2)
@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rapidsms_httprouter.bench import RouterBenchmark, BENCH_APPS
+
+import json
+import os
+import sys
+
+class Command(BaseCommand):
+    help = 'Benchmarks the router against the configured database, outputting results as JSON.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', action='store', dest='messages', type='int', default=200,
+                    help='The number of messages to run through each scenario'),
+        make_option('--apps', action='store', dest='apps', default='noop',
+                    help='Comma separated list of synthetic SMS apps to run, any of: %s' % ", ".join(sorted(BENCH_APPS.keys()))),
+        make_option('--scenarios', action='store', dest='scenarios', default=",".join(RouterBenchmark.scenarios),
+                    help='Comma separated list of scenarios to run, any of: %s' % ", ".join(RouterBenchmark.scenarios)),
+        make_option('--output', action='store', dest='output', default=None,
+                    help='Write results to this file instead of stdout'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help="Don't remove the messages and connections created by the benchmark"),
+    )
+
+    def handle(self, *args, **options):
+        apps = [app for app in options['apps'].split(',') if app]
+        scenarios = [scenario for scenario in options['scenarios'].split(',') if scenario]
+
+        for app in apps:
+            if app not in BENCH_APPS:
+                raise CommandError("Unknown app '%s'" % app)
+
+        for scenario in scenarios:
+            if scenario not in RouterBenchmark.scenarios:
+                raise CommandError("Unknown scenario '%s'" % scenario)
+
+        benchmark = RouterBenchmark(messages=options['messages'], apps=apps, scenarios=scenarios)
+
+        # our send path logs to stdout, keep that out of our results
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results = benchmark.run()
+        finally:
+            sys.stdout = stdout
+            if not options['keep']:
+                benchmark.cleanup()
+
+        output = json.dumps(dict(messages=options['messages'], apps=apps, results=results), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                out.write(output)
+        else:
+            print output
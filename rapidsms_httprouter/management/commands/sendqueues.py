@@ -0,0 +1,76 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rapidsms.models import Backend
+from rapidsms_httprouter.models import get_send_queue, PRIORITY_CHOICES, HIGH_PRIORITY
+from rapidsms_httprouter.utils import get_queue_depth
+
+from collections import OrderedDict
+
+class Command(BaseCommand):
+    help = 'Prints the Celery queues messages are sent from for each backend and priority, and the workers needed to consume them.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--depth', action='store_true', dest='depth', default=False,
+                    help='Also print how many tasks are waiting in each queue, this requires access to your broker'),
+    )
+
+    def get_backends(self):
+        backends = []
+
+        router_url = getattr(settings, 'ROUTER_URL', None)
+        if isinstance(router_url, dict):
+            backends.extend(router_url.keys())
+        else:
+            backends.extend(Backend.objects.values_list('name', flat=True))
+
+        queues = getattr(settings, 'ROUTER_BACKEND_QUEUES', None)
+        if isinstance(queues, dict):
+            backends.extend(backend for backend in queues.keys() if backend != 'default')
+
+        return sorted(set(backends))
+
+    def handle(self, *args, **options):
+        default_queue = getattr(settings, 'CELERY_DEFAULT_QUEUE', 'celery')
+
+        # build up which backends and priorities are sent from each queue
+        queues = OrderedDict()
+        for backend in self.get_backends():
+            for priority, name in PRIORITY_CHOICES:
+                queue = get_send_queue(backend, priority) or default_queue
+                queues.setdefault(queue, []).append("%s (%s)" % (backend, name.lower()))
+
+        if not queues:
+            print "No backends found"
+            return
+
+        width = max(len(queue) for queue in queues)
+        print "%s  %s%s" % ("Queue".ljust(width), "Depth   " if options['depth'] else "", "Backends")
+        for queue, senders in queues.items():
+            depth = ""
+            if options['depth']:
+                depth = get_queue_depth(queue)
+                depth = ("-" if depth is None else str(depth)).ljust(8)
+
+            print "%s  %s%s" % (queue.ljust(width), depth, ", ".join(senders))
+
+        # each backend gets its own workers, so a slow backend only holds up its own messages, and
+        # when replies have their own queue, a worker just for them so they never wait on a campaign
+        workers = OrderedDict()
+        for backend in self.get_backends():
+            backend_queues = [get_send_queue(backend, priority) or default_queue for priority, name in PRIORITY_CHOICES]
+            backend_queues = list(OrderedDict.fromkeys(backend_queues))
+
+            reply_queue = get_send_queue(backend, HIGH_PRIORITY) or default_queue
+            if len(backend_queues) > 1:
+                workers.setdefault(reply_queue, "replies only")
+
+            workers.setdefault(",".join(backend_queues), "all priorities")
+
+        width = max(len(worker_queues) for worker_queues in workers)
+        print
+        print "Workers:"
+        for worker_queues, description in workers.items():
+            print "  python manage.py celery worker -Q %s  # %s" % (worker_queues.ljust(width), description)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from rapidsms.models import Connection
+from rapidsms_httprouter.models import Message
+from rapidsms_httprouter.sharding import get_shards
+
+# the tables whose ids must tell us which shard they are on
+SHARDED_TABLES = (Message, Connection)
+
+class Command(BaseCommand):
+    help = 'Sets up the id sequences on each of our ROUTER_SHARDS so that every id maps back to its shard.'
+
+    def handle(self, *args, **options):
+        shards = get_shards()
+        if not shards:
+            raise CommandError("No ROUTER_SHARDS configured")
+
+        for alias in shards:
+            if connections[alias].vendor != 'postgresql':
+                raise CommandError("Shard '%s' isn't on PostgreSQL, only PostgreSQL sequences can be set up" % alias)
+
+        # find the largest id of each table across all our shards, every shard has to start above it
+        # so that no new id can collide with one already on another shard
+        max_ids = {}
+        for alias in shards:
+            cursor = connections[alias].cursor()
+            for model in SHARDED_TABLES:
+                table = model._meta.db_table
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM %s" % table)
+                max_ids[table] = max(max_ids.get(table, 0), cursor.fetchone()[0])
+
+        for index, alias in enumerate(shards):
+            cursor = connections[alias].cursor()
+
+            for model in SHARDED_TABLES:
+                table = model._meta.db_table
+
+                # start after the largest id on any shard, at the next id which maps to this shard
+                start = (max_ids[table] // len(shards) + 1) * len(shards) + index
+
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                sequence = cursor.fetchone()[0]
+
+                cursor.execute("ALTER SEQUENCE %s INCREMENT BY %d" % (sequence, len(shards)))
+                cursor.execute("SELECT setval(%s, %s, false)", [sequence, start])
+
+                print "%s: %s ids start at %d, incrementing by %d" % (alias, table, start, len(shards))
+
+            transaction.commit_unless_managed(using=alias)
@@ -1,5 +1,6 @@
 import datetime
 
+from django.conf import settings
 from django.db import models, connections
 from django.db.models.query import QuerySet
 
@@ -26,6 +27,58 @@ CANCELLED = 'C'
 ERRORED = 'E'
 FAILED = 'F'
 
+# Priority constants, replies to incoming messages are sent before other messages, and bulk
+# messages such as broadcasts after them
+HIGH_PRIORITY = 20
+NORMAL_PRIORITY = 10
+LOW_PRIORITY = 0
+
+PRIORITY_CHOICES = (
+    (HIGH_PRIORITY, "High"),
+    (NORMAL_PRIORITY, "Normal"),
+    (LOW_PRIORITY, "Low"))
+
+def get_priority_queue(priority):
+    """
+    Returns the Celery queue messages with the passed in priority are sent from, as configured in
+    ROUTER_PRIORITY_QUEUES, or None to use the default queue.
+    """
+    queues = getattr(settings, 'ROUTER_PRIORITY_QUEUES', None)
+    if not queues:
+        return None
+
+    return queues.get(priority, queues.get(NORMAL_PRIORITY, None))
+
+def get_backend_queue(backend):
+    """
+    Returns the Celery queue messages on the passed in backend are sent from, as configured in
+    ROUTER_BACKEND_QUEUES, or None to use the default queue.  ROUTER_BACKEND_QUEUES can either be
+    True, giving each backend its own queue, or a dict of backend name to queue, which lets you group
+    backends together, with an optional 'default' queue for the rest.
+    """
+    queues = getattr(settings, 'ROUTER_BACKEND_QUEUES', None)
+    if not queues:
+        return None
+
+    if queues is True:
+        return 'router.%s' % backend
+
+    return queues.get(backend, queues.get('default', None))
+
+def get_send_queue(backend, priority):
+    """
+    Returns the Celery queue messages on the passed in backend with the passed in priority are
+    sent from.  When both backend and priority queues are configured, each backend gets a queue for
+    each priority.
+    """
+    backend_queue = get_backend_queue(backend)
+    priority_queue = get_priority_queue(priority)
+
+    if backend_queue and priority_queue:
+        return '%s.%s' % (backend_queue, priority_queue)
+
+    return backend_queue or priority_queue
+
 DIRECTION_CHOICES = (
     (INCOMING, "Incoming"),
     (OUTGOING, "Outgoing"))
@@ -51,7 +104,7 @@ class Message(models.Model):
     text       = models.TextField()
 
     direction  = models.CharField(max_length=1, choices=DIRECTION_CHOICES)
-    status     = models.CharField(max_length=1, choices=STATUS_CHOICES)
+    status     = models.CharField(max_length=1, choices=STATUS_CHOICES, db_index=True)
 
     date       = models.DateTimeField(auto_now_add=True)
     updated    = models.DateTimeField(auto_now=True, null=True)
@@ -61,9 +114,12 @@ class Message(models.Model):
 
     in_response_to = models.ForeignKey('self', related_name='responses', null=True, blank=True)
 
-    external_id = models.CharField(max_length=64, null=True, blank=True,
+    external_id = models.CharField(max_length=64, null=True, blank=True, db_index=True,
                                    help_text="An arbitrary id which you can use to map ids assigned by an external backend to your local messages")
 
+    priority   = models.IntegerField(choices=PRIORITY_CHOICES, default=NORMAL_PRIORITY,
+                                     help_text="How urgently this message should be sent, replies are sent before bulk messages")
+
     def __unicode__(self):
         # crop the text (to avoid exploding the admin)
         if len(self.text) < 60: str = self.text
@@ -86,8 +142,35 @@ class Message(models.Model):
         """
         from tasks import send_message_task
 
-        # send this message off in celery
-        send_message_task.delay(self.pk)
+        # send this message off in celery, on the queue for its backend and priority
+        send_message_task.apply_async(args=[self.pk], queue=self.get_send_queue())
+
+    def get_send_queue(self):
+        # only look up our backend if we need it
+        backend = self.connection.backend.name if getattr(settings, 'ROUTER_BACKEND_QUEUES', None) else None
+        return get_send_queue(backend, self.priority)
+
+    def handle_later(self):
+        """
+        Triggers our celery task to handle this incoming message, used when the router is too
+        busy to handle it right away.
+        """
+        from tasks import handle_incoming_task
+        handle_incoming_task.delay(self.pk)
+
+    @classmethod
+    def send_batch(cls, message_ids, priority=NORMAL_PRIORITY, backend=None):
+        """
+        Triggers celery tasks to send off all the messages with the passed in ids, which must all be
+        on the passed in backend.  Each task sends at most ROUTER_SEND_BATCH_SIZE messages, so large
+        batches are spread across our workers rather than sent one after another by a single one.
+        """
+        from tasks import send_messages_task
+
+        batch_size = getattr(settings, 'ROUTER_SEND_BATCH_SIZE', 50)
+        queue = get_send_queue(backend, priority)
+        for start in range(0, len(message_ids), batch_size):
+            send_messages_task.apply_async(args=[message_ids[start:start + batch_size]], queue=queue)
 
 class DeliveryError(models.Model):
     """
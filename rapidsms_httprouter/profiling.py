@@ -0,0 +1,198 @@
+"""
+Sampled profiling of the router's views.
+
+Profiling is off unless ROUTER_PROFILE_DIR is set.  When it is, a sample of requests to the
+router's views are run under cProfile, as well as any request carrying an X-Router-Profile
+header matching ROUTER_PROFILE_SECRET.  Profiles are aggregated by view and written to the
+directory every ROUTER_PROFILE_FLUSH_EVERY requests, along with a JSON summary of how much time
+went to SQL, to our SMS apps and to serializing responses.  Old files are removed to keep the
+directory within its limits.  The following settings control this:
+
+    ROUTER_PROFILE_DIR = '/var/log/router/profiles'
+    ROUTER_PROFILE_RATE = 0.01                  # the fraction of requests to profile
+    ROUTER_PROFILE_SECRET = 'landshark'         # requests with this header value are always profiled
+    ROUTER_PROFILE_FLUSH_EVERY = 100            # profiled requests aggregated into each file
+    ROUTER_PROFILE_MAX_FILES = 100
+    ROUTER_PROFILE_MAX_BYTES = 50 * 1024 * 1024
+
+Profiles can be read using pstats, ie:
+
+    python -c "import pstats; pstats.Stats('receive-1380000000-1234.prof').sort_stats('cumulative').print_stats(30)"
+"""
+from django.conf import settings
+
+from functools import wraps
+from threading import Lock
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import time
+
+from .utils import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+# the header which forces a request to be profiled
+PROFILE_HEADER = 'HTTP_X_ROUTER_PROFILE'
+
+# the functions whose cumulative time we report for each section, by file and function name
+PROFILE_SECTIONS = {
+    'apps': (('router.py', 'process_incoming_phases'),
+             ('router.py', 'process_outgoing_phases'),
+             ('router.py', 'process_outgoing_batch')),
+    'serialization': (('models.py', 'as_json'),
+                      ('json/__init__.py', 'dumps')),
+}
+
+
+def get_section_times(stats):
+    """
+    Returns the cumulative time spent in each of our sections for the passed in pstats.Stats.
+    """
+    times = dict((section, 0.0) for section in PROFILE_SECTIONS)
+
+    for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+        for section, functions in PROFILE_SECTIONS.items():
+            for section_file, section_function in functions:
+                if function == section_function and filename.endswith(section_file):
+                    times[section] += ct
+
+    return times
+
+
+class ViewProfiler(object):
+    """
+    Profiles requests to our views, aggregating the results by view until they are written out.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = dict()
+
+    def get_directory(self):
+        return getattr(settings, 'ROUTER_PROFILE_DIR', None)
+
+    def should_profile(self, request):
+        if not self.get_directory():
+            return False
+
+        secret = getattr(settings, 'ROUTER_PROFILE_SECRET', None)
+        if secret and request.META.get(PROFILE_HEADER, None) == secret:
+            return True
+
+        rate = getattr(settings, 'ROUTER_PROFILE_RATE', 0)
+        return rate and random.random() < rate
+
+    def profile(self, name, func, request, *args, **kwargs):
+        """
+        Calls the passed in view under our profiler, recording the results under the passed in name.
+        """
+        profile = cProfile.Profile()
+
+        start = time.time()
+        with QueryCounter() as counter:
+            response = profile.runcall(func, request, *args, **kwargs)
+        elapsed = time.time() - start
+
+        # requests asking to be profiled get their own files, so they can be found easily
+        try:
+            self.record(name, profile, elapsed, counter, request.META.get(PROFILE_HEADER, None) is not None)
+        except Exception as e:
+            logger.warning("Unable to record profile for %s: %s" % (name, e))
+
+        return response
+
+    def record(self, name, profile, elapsed, counter, flush=False):
+        stats = pstats.Stats(profile)
+        sections = get_section_times(stats)
+
+        with self.lock:
+            pending = self.pending.get(name, None)
+            if pending is None:
+                pending = self.pending[name] = dict(stats=stats, requests=0, total=0.0, queries=0, sql=0.0,
+                                                    apps=0.0, serialization=0.0)
+            else:
+                pending['stats'].add(stats)
+
+            pending['requests'] += 1
+            pending['total'] += elapsed
+            pending['queries'] += counter.count
+            pending['sql'] += counter.time
+            pending['apps'] += sections['apps']
+            pending['serialization'] += sections['serialization']
+
+            if flush or pending['requests'] >= getattr(settings, 'ROUTER_PROFILE_FLUSH_EVERY', 100):
+                del self.pending[name]
+            else:
+                pending = None
+
+        if pending:
+            self.write(name, pending)
+
+    def write(self, name, pending):
+        """
+        Writes out the aggregated profile and summary for the passed in view, then rotates our files.
+        """
+        directory = self.get_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, '%s-%d-%d' % (name, int(time.time() * 1000), os.getpid()))
+        pending.pop('stats').dump_stats(path + '.prof')
+
+        summary = dict((key, round(value, 6) if isinstance(value, float) else value)
+                       for key, value in pending.items())
+        summary['view'] = name
+        summary['other'] = round(pending['total'] - pending['sql'] - pending['apps'] - pending['serialization'], 6)
+
+        with open(path + '.json', 'w') as summary_file:
+            summary_file.write(json.dumps(summary))
+
+        self.rotate(directory)
+
+    def rotate(self, directory):
+        """
+        Removes the oldest files in the passed in directory until it is within our limits.
+        """
+        max_files = getattr(settings, 'ROUTER_PROFILE_MAX_FILES', 100)
+        max_bytes = getattr(settings, 'ROUTER_PROFILE_MAX_BYTES', 50 * 1024 * 1024)
+
+        files = []
+        for filename in os.listdir(directory):
+            if filename.endswith('.prof') or filename.endswith('.json'):
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+
+        files.sort()
+        total = sum(size for mtime, path, size in files)
+
+        while files and (len(files) > max_files or total > max_bytes):
+            mtime, path, size = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+profiler = ViewProfiler()
+
+
+def profiled(name):
+    """
+    Decorator which profiles a sample of the requests made to a view, ie:
+
+        @profiled('receive')
+        def receive(request):
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            if profiler.should_profile(request):
+                return profiler.profile(name, func, request, *args, **kwargs)
+            return func(request, *args, **kwargs)
+        return wrapper
+    return decorator
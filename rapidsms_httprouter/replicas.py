@@ -0,0 +1,187 @@
+"""
+Read replica support.
+
+The console, outbox, status page and message admin only read messages and can tolerate being a
+few seconds behind, so they can be pointed at a read replica, leaving the primary database free
+for the writes made as messages are received and sent.  To enable this, add your replica to
+DATABASES and configure:
+
+    DATABASE_ROUTERS = ['rapidsms_httprouter.replicas.ReplicaRouter']
+    ROUTER_REPLICA_DB = 'replica'
+    ROUTER_REPLICA_MAX_LAG = 30                 # seconds behind before we fall back to the primary
+    ROUTER_REPLICA_LAG_CHECK_INTERVAL = 5       # how often we check how far behind the replica is
+
+Only reads made within use_replica are sent to the replica, everything else, including any reads
+made while handling messages, sending them or marking them delivered, stays on the primary.
+
+Read replicas can't be used along with ROUTER_SHARDS, as reads would be sent to the replica of a
+single database whichever shard they were for.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+from functools import wraps
+from threading import local, Lock
+import logging
+import time
+
+from .sharding import get_shards
+
+logger = logging.getLogger(__name__)
+
+# the database alias reads are currently being routed to, by thread
+_reads = local()
+
+# our last measurement of the replica lag, shared across threads
+_lag_lock = Lock()
+_lag = dict(alias=None, lag=None, checked=0)
+
+
+def get_replica_alias():
+    alias = getattr(settings, 'ROUTER_REPLICA_DB', None)
+    if alias and get_shards():
+        raise ImproperlyConfigured("ROUTER_REPLICA_DB can't be used along with ROUTER_SHARDS")
+
+    if alias and alias in settings.DATABASES:
+        return alias
+    return None
+
+
+def get_replica_lag(alias):
+    """
+    Returns how many seconds behind its primary the passed in replica is, or None if we can't
+    tell, in which case the replica shouldn't be used.
+    """
+    connection = connections[alias]
+    cursor = connection.cursor()
+
+    if connection.vendor == 'postgresql':
+        # PostgreSQL 10 renamed its xlog functions to wal ones
+        if connection.pg_version >= 100000:
+            receive, replay = 'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+        else:
+            receive, replay = 'pg_last_xlog_receive_location()', 'pg_last_xlog_replay_location()'
+
+        cursor.execute("SELECT %s = %s, EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())" % (receive, replay))
+        caught_up, lag = cursor.fetchone()
+
+        # these are NULL when we aren't replicating, or haven't replayed anything yet
+        if caught_up is None:
+            return None
+        elif caught_up:
+            return 0
+        return float(lag) if lag is not None else None
+
+    elif connection.vendor == 'mysql':
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if not row:
+            return 0
+
+        columns = [column[0] for column in cursor.description]
+        lag = dict(zip(columns, row))['Seconds_Behind_Master']
+        return float(lag) if lag is not None else None
+
+    # other databases have no way of telling us, assume they are up to date
+    return 0
+
+
+def get_cached_replica_lag(alias):
+    """
+    Returns the lag of the passed in replica, only checking it every ROUTER_REPLICA_LAG_CHECK_INTERVAL seconds.
+    """
+    interval = getattr(settings, 'ROUTER_REPLICA_LAG_CHECK_INTERVAL', 5)
+
+    with _lag_lock:
+        now = time.time()
+        if _lag['alias'] != alias or now - _lag['checked'] >= interval:
+            try:
+                lag = get_replica_lag(alias)
+            except Exception as e:
+                logger.warning("Unable to check lag of replica '%s': %s" % (alias, e))
+                lag = None
+
+            _lag.update(alias=alias, lag=lag, checked=now)
+
+        return _lag['lag']
+
+
+def get_read_alias():
+    """
+    Returns the replica alias reads should go to, or None if they should go to the primary because
+    no replica is configured or it is too far behind.
+    """
+    alias = get_replica_alias()
+    if not alias:
+        return None
+
+    lag = get_cached_replica_lag(alias)
+    if lag is None or lag > getattr(settings, 'ROUTER_REPLICA_MAX_LAG', 30):
+        return None
+
+    return alias
+
+
+class use_database(object):
+    """
+    Routes the reads made within a block or function to the database alias returned by get_alias,
+    restoring the previous routing afterwards.  get_alias is called each time the block is entered,
+    so a replica that falls behind stops being used by functions decorated before it did.
+    """
+    def __init__(self, get_alias):
+        self.get_alias = get_alias
+
+    def __enter__(self):
+        self.previous = getattr(_reads, 'alias', None)
+        _reads.alias = self.get_alias()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _reads.alias = self.previous
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with use_database(self.get_alias):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class use_replica(use_database):
+    """
+    Sends reads to the replica if one is configured and up to date, ie:
+
+        @use_replica()
+        def outbox(request):
+    """
+    def __init__(self):
+        super(use_replica, self).__init__(get_read_alias)
+
+
+class use_primary(use_database):
+    """
+    Keeps reads on the primary, even within use_replica.  Used on paths which need to read their
+    own writes.
+    """
+    def __init__(self):
+        super(use_primary, self).__init__(lambda: None)
+
+
+class ReplicaRouter(object):
+    """
+    Django database router which sends reads made within use_replica to our replica.
+    """
+    def db_for_read(self, model, **hints):
+        return getattr(_reads, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # our replica has the same data as our primary, so objects from either can be related
+        return True
+
+    def allow_syncdb(self, db, model):
+        # never try to create tables on our replica
+        return db != get_replica_alias()
@@ -1,12 +1,23 @@
 from django.conf import settings
-from django.db import transaction
-from .models import Message
+from django.db import transaction, DatabaseError
+from django.db.models import Max
+from .models import Message, HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY
+from .utils import iterate_batches, can_return_ids, bulk_create_returning_ids
+from .budgets import query_budget, exclude_queries
+from .state import ConnectionStateStore
+from .dedup import DuplicateFilter, PENDING
+from .admission import AdmissionController
+from .replicas import use_primary
+from .watchdog import AppBudgets
+from .longpoll import notify_outbox
+from .sharding import use_shard, get_shard, get_shard_for_id, get_shard_for_connection, get_current_shard
 from rapidsms.models import Backend, Connection
 from rapidsms.apps.base import AppBase
 from rapidsms.messages.incoming import IncomingMessage
 from rapidsms.messages.outgoing import OutgoingMessage
 from rapidsms.log.mixin import LoggerMixin
-from threading import Lock, Thread
+from threading import Lock, Thread, local
+from collections import OrderedDict
 
 from urllib import quote_plus
 from urllib2 import urlopen
@@ -14,6 +25,7 @@ import time
 import re
 import datetime
 import traceback
+from contextlib import contextmanager
 
 class HttpRouter(object, LoggerMixin):
     """
@@ -31,6 +43,22 @@ class HttpRouter(object, LoggerMixin):
         # we need to be started
         self.started = False
 
+        # messages waiting on a transaction to commit before being sent, per thread
+        self.pending = local()
+
+        # conversation state for our connections, made available to apps as msg.state, changes
+        # are saved with the messages they were made by
+        self.state = ConnectionStateStore(after_commit=self.send_after_commit)
+
+        # the incoming messages we've seen recently
+        self.duplicates = DuplicateFilter()
+
+        # tracks how many messages we are handling, so we can refuse more when overloaded
+        self.admission = AdmissionController()
+
+        # times our apps, so one slow app can't hold up every message
+        self.app_budgets = AppBudgets()
+
     @classmethod
     def fetch_url(cls, url, params):
         """
@@ -57,17 +85,18 @@ class HttpRouter(object, LoggerMixin):
         Adds this message to the db.  This is both for logging, and we also keep state
         tied to it.
         """
-        # lookup / create this backend
-        # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse 
-        # any backends not found in our settings.  But I hate dropping messages on the floor.
-        backend, created = Backend.objects.get_or_create(name=backend)
         contact = HttpRouter.normalize_number(contact)
 
-        # try to find a connection
-        connection = Connection.objects.filter(backend=backend, identity=contact)
+        # try to find a connection, apps almost always use its backend and contact so load those too
+        connection = list(Connection.objects.select_related('backend', 'contact')
+                                            .filter(backend__name=backend, identity=contact)[:1])
 
         # if not found, create it
         if not connection:
+            # lookup / create this backend
+            # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse
+            # any backends not found in our settings.  But I hate dropping messages on the floor.
+            backend, created = Backend.objects.get_or_create(name=backend)
             connection = Connection.objects.create(backend=backend, identity=contact)
         else:
             connection = connection[0]
@@ -80,30 +109,215 @@ class HttpRouter(object, LoggerMixin):
                                          status=status)
         return message
 
+    @use_primary()
+    @query_budget('delivered')
     def mark_delivered(self, message_id):
         """
         Marks a message as delivered by the backend.
         """
-        message = Message.objects.get(pk=message_id)
-        message.status = 'D'
-        message.delivered = datetime.datetime.now()
-        message.save()
+        with use_shard(get_shard_for_id(message_id)):
+            message = Message.objects.get(pk=message_id)
+            message.status = 'D'
+            message.delivered = datetime.datetime.now()
+            message.save(force_update=True)
+
+    def get_shard(self, backend, identity):
+        """
+        Returns the shard the connection for the passed in backend and identity lives on, if sharding.
+        """
+        return get_shard(backend, HttpRouter.normalize_number(identity))
 
     def handle_incoming(self, backend, sender, text):
         """
-        Handles an incoming message.
+        Handles an incoming message.  All the database work for the message and its responses
+        is done in a single transaction, responses are only sent once it has been committed.
         """
-        # create our db message for logging
-        db_message = self.add_message(backend, sender, text, 'I', 'R')
+        with use_shard(self.get_shard(backend, sender)), self.send_on_commit():
+            with query_budget('handle_incoming') as budget:
+                # create our db message for logging
+                db_message = self.add_message(backend, sender, text, 'I', 'R')
+                self.process_incoming(db_message, budget)
+
+        return db_message
+
+    def queue_incoming(self, backend, sender, text):
+        """
+        Adds an incoming message to the db without handling it, instead handing it off to Celery
+        to be handled later.  This is used when we are too busy to handle messages as they arrive.
+        """
+        with use_shard(self.get_shard(backend, sender)), self.send_on_commit():
+            db_message = self.add_message(backend, sender, text, 'I', 'R')
+            self.send_after_commit(db_message.handle_later)
+
+        self.info("SMS[%d] QUEUED (%s) : %s" % (db_message.id, db_message.connection, text))
+        return db_message
+
+    def handle_queued_incoming(self, message_id):
+        """
+        Handles an incoming message which was previously queued by queue_incoming.
+        """
+        with use_shard(get_shard_for_id(message_id)), self.send_on_commit():
+            with query_budget('handle_incoming') as budget:
+                db_message = Message.objects.select_related('connection__backend', 'connection__contact').get(pk=message_id)
+
+                # only handle messages once
+                if db_message.status == 'R':
+                    self.process_incoming(db_message, budget)
+
+        return db_message
+
+    def process_incoming(self, db_message, budget):
+        """
+        Passes the passed in db message through our apps, then sends off any responses.  The
+        queries made by our apps are excluded from the passed in budget.
+        """
+        # our rapidsms transient message for processing
+        msg = IncomingMessage(db_message.connection, db_message.text, db_message.date)
 
-        # and our rapidsms transient message for processing
-        msg = IncomingMessage(db_message.connection, text, db_message.date)
-        
         # add an extra property to IncomingMessage, so httprouter-aware
         # apps can make use of it during the handling phase
         msg.db_message = db_message
-        
+        msg.state = self.state.for_connection(db_message.connection)
+
         self.info("SMS[%d] IN (%s) : %s" % (db_message.id, msg.connection, msg.text))
+
+        # the queries our apps make are out of our control
+        with budget.exclude():
+            self.process_incoming_phases(msg)
+
+        db_message.status = 'H'
+        db_message.save(force_update=True)
+
+        # now send the message responses
+        while msg.responses:
+            response = msg.responses.pop(0)
+            self.handle_outgoing(response, db_message)
+            budget.items += 1
+
+        # we are no longer interested in this message... but some crazy
+        # synchronous backends might be, so mark it as processed.
+        msg.processed = True
+
+    def handle_incoming_once(self, backend, sender, text, external_id=None):
+        """
+        Handles an incoming message, unless we've already seen the same message within the last
+        ROUTER_DEDUP_WINDOW seconds, which happens when backends retry requests that timed out.
+        The external id is the id assigned to the message by the backend, if any.
+
+        Returns a tuple of the message and whether it was a duplicate.  For duplicates this is the
+        original message, or None if the original message is still being handled.
+        """
+        return self.receive_once(self.handle_incoming, backend, sender, text, external_id)
+
+    def queue_incoming_once(self, backend, sender, text, external_id=None):
+        """
+        Queues an incoming message to be handled later, unless we've already seen the same message
+        within our deduplication window.  Backends retry the most when we are overloaded, which is
+        when messages are queued.  Returns a tuple as handle_incoming_once does.
+        """
+        return self.receive_once(self.queue_incoming, backend, sender, text, external_id)
+
+    def receive_once(self, receive, backend, sender, text, external_id):
+        """
+        Calls the passed in receive function with the passed in message, unless it is a duplicate
+        of a message we've already seen.
+        """
+        if not self.duplicates.get_window():
+            return receive(backend, sender, text), False
+
+        key = self.duplicates.get_key(backend, sender, text, external_id)
+        original = self.duplicates.claim(key)
+
+        if original is not None:
+            self.info("SMS DUPLICATE (%s %s) : %s" % (backend, sender, text))
+            if original == PENDING:
+                return None, True
+
+            with use_shard(get_shard_for_id(original)):
+                original = list(Message.objects.filter(pk=int(original))[:1])
+            return (original[0] if original else None), True
+
+        try:
+            db_message = receive(backend, sender, text)
+        except:
+            self.duplicates.release(key)
+            raise
+
+        self.duplicates.complete(key, db_message.pk)
+        return db_message, False
+
+    @contextmanager
+    def send_on_commit(self):
+        """
+        Runs the wrapped block in a single transaction, holding on to any messages sent within it
+        until that transaction has been committed.  This way Celery never sees a message before
+        it is visible in the database, and messages are dropped if the transaction is rolled back.
+        Reads within the block always go to the primary database, so we see our own writes.  When
+        sharding, the transaction is on the shard we are currently working on.
+        """
+        # we are already within a block, our outer one will take care of things
+        if getattr(self.pending, 'sends', None) is not None:
+            yield
+            return
+
+        self.pending.sends = []
+        try:
+            with use_primary(), transaction.commit_on_success(using=get_current_shard()):
+                yield
+
+            sends, self.pending.sends = self.pending.sends, None
+            for send in sends:
+                send()
+
+        finally:
+            self.pending.sends = None
+
+    @contextmanager
+    def app_savepoint(self):
+        """
+        Runs the wrapped app call within a savepoint when we are within a transaction, so that any
+        database errors it causes are rolled back on their own rather than aborting the transaction
+        the message is being handled in.  This includes errors the app caught itself, which leave
+        the transaction aborted and make releasing the savepoint fail.  Our savepoint queries don't
+        count against any query budgets, as they depend on how many apps are installed.
+        """
+        using = get_current_shard()
+        if not transaction.is_managed(using=using):
+            yield
+            return
+
+        with exclude_queries():
+            sid = transaction.savepoint(using=using)
+        try:
+            yield
+        except:
+            with exclude_queries():
+                transaction.savepoint_rollback(sid, using=using)
+            raise
+
+        with exclude_queries():
+            try:
+                transaction.savepoint_commit(sid, using=using)
+            except DatabaseError:
+                transaction.savepoint_rollback(sid, using=using)
+
+    def send_after_commit(self, send):
+        """
+        Calls the passed in send function, waiting until our current transaction is committed if
+        we are within a send_on_commit block.
+        """
+        pending = getattr(self.pending, 'sends', None)
+        if pending is not None:
+            pending.append(send)
+        else:
+            send()
+
+    def process_incoming_phases(self, msg):
+        """
+        Passes the passed in message through the incoming phases for all our configured SMS apps.
+        Apps are timed against their budgets, and skipped once the message has used up its own.
+        """
+        start = time.time()
         try:
             for phase in self.incoming_phases:
                 self.debug("In %s phase" % phase)
@@ -116,9 +330,15 @@ class HttpRouter(object, LoggerMixin):
                     self.debug("In %s app" % app)
                     handled = False
 
+                    if self.app_budgets.is_exhausted(start):
+                        self.warning("Message over its time budget, skipping remaining apps")
+                        raise(StopIteration)
+
                     try:
                         func = getattr(app, phase)
-                        handled = func(msg)
+                        with self.app_savepoint(), \
+                             self.app_budgets.timed(app, phase, self.app_budgets.get_remaining(start)):
+                            handled = func(msg)
 
                     except Exception, err:
                         import traceback
@@ -153,58 +373,188 @@ class HttpRouter(object, LoggerMixin):
         except StopIteration:
             pass
 
-        db_message.status = 'H'
-        db_message.save()
-        
-        db_responses = []
-
-        # now send the message responses
-        while msg.responses:
-            response = msg.responses.pop(0)
-            self.handle_outgoing(response, db_message)
-
-        # we are no longer interested in this message... but some crazy
-        # synchronous backends might be, so mark it as processed.
-        msg.processed = True
-
-        return db_message
-
 
-    def add_outgoing(self, connection, text, source=None, status='Q'):
+    @query_budget('add_outgoing')
+    def add_outgoing(self, connection, text, source=None, status='Q', priority=None):
         """
-        Adds a message to our outgoing queue, this is a non-blocking action
+        Adds a message to our outgoing queue, this is a non-blocking action.  Unless a priority is
+        given, replies to incoming messages are sent with a high priority, everything else normal.
         """
-        db_message = Message.objects.create(connection=connection,
-                                            text=unicode(text),
-                                            direction='O',
-                                            status=status,
-                                            in_response_to=source)
-        self.info("SMS[%d] OUT (%s) : %s" % (db_message.id, str(connection), text))
-
-        # process our outgoing phases
-        self.process_outgoing_phases(db_message)
-
-        # if it wasn't cancelled
-        if db_message.status != 'C':
-            # queue it
-            db_message.status = 'Q'
-            db_message.save()
-
-        # if we have a router URL, send the message off
+        if priority is None:
+            priority = HIGH_PRIORITY if source else NORMAL_PRIORITY
+
+        with use_shard(get_shard_for_connection(connection)):
+            db_message = Message.objects.create(connection=connection,
+                                                text=unicode(text),
+                                                direction='O',
+                                                status=status,
+                                                in_response_to=source,
+                                                priority=priority)
+            self.info("SMS[%d] OUT (%s) : %s" % (db_message.id, str(connection), text))
+
+            # process our outgoing phases
+            self.process_outgoing_phases(db_message)
+
+            # if it wasn't cancelled
+            if db_message.status != 'C':
+                # queue it
+                db_message.status = 'Q'
+                db_message.save(force_update=True)
+
+        # if we have a router URL, send the message off, otherwise wake up anybody waiting on our outbox
         if getattr(settings, 'ROUTER_URL', None):
-            db_message.send()
+            self.send_after_commit(db_message.send)
+        elif db_message.status == 'Q':
+            self.send_after_commit(lambda: notify_outbox(connection.backend.name))
 
         return db_message
                 
     def handle_outgoing(self, msg, source=None):
         """
         Sends the passed in RapidSMS message off.  Optionally ties the outgoing message to the incoming
-        message which triggered it.
+        message which triggered it.  Apps can set a priority on the message to override our default.
         """
         # add it to our outgoing queue
-        db_message = self.add_outgoing(msg.connection, msg.text, source, status='P')
+        db_message = self.add_outgoing(msg.connection, msg.text, source, status='P',
+                                       priority=getattr(msg, 'priority', None))
         return db_message
 
+    def broadcast(self, backend, identities, text, batch_size=500):
+        """
+        Sends the passed in text to all the passed in identities on the passed in backend.  This is
+        much faster than calling add_outgoing for each identity, as connections and messages are
+        created in bulk, batch_size at a time.  Identities can be any iterable, so large lists of
+        recipients can be streamed in.  Broadcasts are sent with a low priority, so they don't hold
+        up replies.  Duplicate identities are only dropped within a batch, so recipients listed in
+        more than one batch are sent the text more than once.
+
+        Returns the number of messages that were queued.
+        """
+        count = 0
+        for batch in iterate_batches(identities, batch_size):
+            # each batch is created in its own transaction on each shard
+            for shard, shard_batch in self.group_by_shard(backend, batch):
+                with use_shard(shard), self.send_on_commit():
+                    backend_obj, created = Backend.objects.get_or_create(name=backend)
+                    count += self.broadcast_batch(backend_obj, shard_batch, text)
+
+        return count
+
+    def group_by_shard(self, backend, identities):
+        """
+        Splits the passed in identities up by the shard their connections live on, returning a list of
+        tuples of shard and identities.
+        """
+        shards = OrderedDict()
+        for identity in identities:
+            shards.setdefault(self.get_shard(backend, identity), []).append(identity)
+        return shards.items()
+
+    def broadcast_batch(self, backend, identities, text):
+        """
+        Sends the passed in text to a single batch of identities, returning the number of messages
+        that were queued.
+        """
+        # normalize our identities, dropping any duplicates
+        identities = list(OrderedDict.fromkeys(HttpRouter.normalize_number(identity) for identity in identities))
+
+        # look up our existing connections, creating any that are missing
+        connections = dict((c.identity, c) for c in Connection.objects.filter(backend=backend, identity__in=identities))
+        missing = [identity for identity in identities if identity not in connections]
+        if missing:
+            Connection.objects.bulk_create([Connection(backend=backend, identity=identity) for identity in missing])
+            for connection in Connection.objects.filter(backend=backend, identity__in=missing):
+                connections[connection.identity] = connection
+
+        text = unicode(text)
+        messages = [Message(connection=connections[identity], text=text, direction='O', status='Q',
+                            priority=LOW_PRIORITY)
+                    for identity in identities]
+
+        # process our outgoing phases, which may cancel some of our messages
+        self.process_outgoing_batch(messages)
+
+        queued = [message for message in messages if message.status == 'Q']
+        send = queued and getattr(settings, 'ROUTER_URL', None)
+
+        # bulk creation doesn't give us our ids back, when we need them we have our insert return
+        # them if our database can, otherwise we look up the queued messages to our connections
+        # created after the last message before our batch
+        if send and can_return_ids(Message):
+            bulk_create_returning_ids(Message, messages)
+            message_ids = [message.pk for message in queued]
+        elif send:
+            last_id = Message.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            Message.objects.bulk_create(messages)
+            message_ids = list(Message.objects.filter(pk__gt=last_id, direction='O', status='Q', text=text,
+                                                      connection__in=[m.connection for m in queued])
+                                              .values_list('id', flat=True))
+        else:
+            Message.objects.bulk_create(messages)
+
+        self.info("SMS BROADCAST (%s) %d queued, %d cancelled : %s" % (backend.name, len(queued), len(messages) - len(queued), text))
+
+        # if we have a router URL, send the whole batch off at once
+        if send:
+            self.send_after_commit(lambda: Message.send_batch(message_ids, LOW_PRIORITY, backend.name))
+        elif queued:
+            self.send_after_commit(lambda: notify_outbox(backend.name))
+
+        return len(queued)
+
+    def process_outgoing_batch(self, outgoing):
+        """
+        Passes the passed in list of unsaved messages through the outgoing phases of our SMS apps.
+
+        Apps which implement a vectorized version of a phase, ie: outgoing_batch(msgs), are called
+        once with every message, and can return a list of booleans, False cancelling the message at
+        that position.  All other apps are called once per message as in process_outgoing_phases.
+        Cancelled messages have their status set to 'C'.
+        """
+        msgs = []
+        for db_message in outgoing:
+            msg = OutgoingMessage(db_message.connection, db_message.text.replace('%','%%'))
+            msg.db_message = db_message
+            msgs.append(msg)
+
+        for phase in self.outgoing_phases:
+            self.debug("Out %s batch phase" % phase)
+
+            # call outgoing phases in the opposite order of the incoming phases
+            for app in reversed(self.apps):
+                self.debug("Out %s batch app" % app)
+
+                # only pass on messages which haven't been cancelled yet
+                msgs = [msg for msg in msgs if msg.db_message.status != 'C']
+                if not msgs:
+                    return
+
+                batch_func = getattr(app, "%s_batch" % phase, None)
+                if batch_func:
+                    try:
+                        with self.app_savepoint():
+                            results = batch_func(msgs)
+                    except Exception, err:
+                        app.exception()
+                        results = None
+
+                    # we have to do things this way because by default apps return None
+                    if results is not None:
+                        for msg, keep_sending in zip(msgs, results):
+                            if keep_sending is False:
+                                msg.db_message.status = 'C'
+
+                else:
+                    func = getattr(app, phase)
+                    for msg in msgs:
+                        try:
+                            with self.app_savepoint():
+                                keep_sending = func(msg)
+                            if keep_sending is False:
+                                msg.db_message.status = 'C'
+                        except Exception, err:
+                            app.exception()
+
     def process_outgoing_phases(self, outgoing):
         """
         Passes the passed in message through the outgoing phase for all our configured SMS apps.
@@ -228,7 +578,8 @@ class HttpRouter(object, LoggerMixin):
 
                 try:
                     func = getattr(app, phase)
-                    keep_sending = func(msg)
+                    with self.app_savepoint():
+                        keep_sending = func(msg)
 
                     # we have to do things this way because by default apps return
                     # None from outgoing()
@@ -241,7 +592,7 @@ class HttpRouter(object, LoggerMixin):
                 # abort ALL further processing of this message
                 if not send_msg:
                     outgoing.status = 'C'
-                    outgoing.save()
+                    outgoing.save(force_update=True)
 
                     self.warning("Message cancelled")
                     send_msg = False
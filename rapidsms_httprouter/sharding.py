@@ -0,0 +1,207 @@
+"""
+Sharding of messages and connections across databases.
+
+When a single database can no longer keep up with the messages being written to it, messages,
+connections and everything they depend on can be spread across several databases, each with the
+full schema.  Every connection lives on a single shard, along with all of its messages, chosen
+either by the name of its backend or by a hash of its backend and identity:
+
+    DATABASE_ROUTERS = ['rapidsms_httprouter.sharding.ShardRouter']
+    ROUTER_SHARDS = ['default', 'shard1', 'shard2']
+    ROUTER_SHARD_BY = 'backend'                 # or 'connection'
+    ROUTER_SHARD_BACKENDS = {'mtn': 'shard1'}   # optionally pins backends to shards
+
+Message ids are used to find messages again when they are sent or delivered, so each shard only
+hands out ids which are equal to its position in ROUTER_SHARDS modulo the number of shards.  The
+setupshards management command configures the id sequences on each shard to do this.
+
+Handling, sending and delivering messages work on a single shard, views which list messages such
+as the console and outbox read from every shard and merge the results.
+
+Objects can only be related to objects on the same shard, so any app whose models refer to
+contacts, connections or messages must be sharded along with them:
+
+    ROUTER_SHARDED_APPS = ['rapidsms', 'rapidsms_httprouter', 'polls']
+
+Models in apps which aren't sharded live in our default database, and can't be related to sharded
+models.
+"""
+from django.conf import settings
+
+from functools import wraps
+from threading import local
+import zlib
+
+# the apps whose models are always sharded, everything else stays in our default database unless
+# it's added to ROUTER_SHARDED_APPS
+SHARDED_APPS = ('rapidsms', 'rapidsms_httprouter')
+
+# the shard our current thread is working on
+_shard = local()
+
+
+def get_shards():
+    return list(getattr(settings, 'ROUTER_SHARDS', None) or [])
+
+
+def get_sharded_apps():
+    return set(SHARDED_APPS) | set(getattr(settings, 'ROUTER_SHARDED_APPS', None) or [])
+
+
+def get_shard(backend, identity):
+    """
+    Returns the shard the connection with the passed in backend name and normalized identity lives
+    on, or None if we aren't sharding.
+    """
+    shards = get_shards()
+    if not shards:
+        return None
+
+    if getattr(settings, 'ROUTER_SHARD_BY', 'backend') == 'connection':
+        key = '%s:%s' % (backend, identity)
+    else:
+        pinned = getattr(settings, 'ROUTER_SHARD_BACKENDS', {}).get(backend, None)
+        if pinned:
+            return pinned
+        key = backend
+
+    return shards[(zlib.crc32(key.encode('utf-8')) & 0xffffffff) % len(shards)]
+
+
+def get_shard_for_id(object_id):
+    """
+    Returns the shard the message or connection with the passed in id lives on, or None if we
+    aren't sharding.
+    """
+    shards = get_shards()
+    if not shards:
+        return None
+
+    return shards[int(object_id) % len(shards)]
+
+
+def get_shard_for_connection(connection):
+    shards = get_shards()
+    if not shards:
+        return None
+
+    if connection._state.db in shards:
+        return connection._state.db
+
+    return get_shard(connection.backend.name, connection.identity)
+
+
+def get_current_shard():
+    return getattr(_shard, 'alias', None)
+
+
+def shard_querysets(queryset):
+    """
+    Returns a copy of the passed in queryset for each of our shards, or just the queryset itself if
+    we aren't sharding.
+    """
+    shards = get_shards()
+    if not shards:
+        return [queryset]
+
+    return [queryset.using(alias) for alias in shards]
+
+
+class use_shard(object):
+    """
+    Routes the queries made within a block or function to the passed in shard, ie:
+
+        with use_shard(get_shard_for_id(message_id)):
+            message = Message.objects.get(pk=message_id)
+    """
+    def __init__(self, alias):
+        self.alias = alias
+
+    def __enter__(self):
+        self.previous = getattr(_shard, 'alias', None)
+        _shard.alias = self.alias
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _shard.alias = self.previous
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with use_shard(self.alias):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class ShardedList(object):
+    """
+    Merges the results of the same query across our shards, newest first.  Supports counting and
+    slicing, so it can be paginated.  Getting a page means fetching everything up to the end of
+    that page from every shard, so later pages get more expensive.
+    """
+    def __init__(self, querysets):
+        self.querysets = [queryset.order_by('-id') for queryset in querysets]
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(queryset.count() for queryset in self.querysets)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            if stop is None:
+                stop = self.count()
+        else:
+            start, stop = index, index + 1
+
+        items = []
+        for queryset in self.querysets:
+            items.extend(queryset[:stop])
+
+        # ids aren't ordered across shards, but dates are
+        items.sort(key=lambda item: (item.date, item.pk), reverse=True)
+
+        if isinstance(index, slice):
+            return items[start:stop]
+        return items[start]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class ShardRouter(object):
+    """
+    Django database router which sends queries for sharded models to the shard we are working on,
+    or the shard of the object they relate to.
+    """
+    def get_shard(self, model, hints):
+        if model._meta.app_label not in get_sharded_apps():
+            return None
+
+        instance = hints.get('instance', None)
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        return get_current_shard()
+
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.get_shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # objects can only be related to objects on the same shard
+        apps = get_sharded_apps()
+        if obj1._meta.app_label in apps or obj2._meta.app_label in apps:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_syncdb(self, db, model):
+        # every shard has the full schema
+        return None
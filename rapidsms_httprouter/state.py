@@ -0,0 +1,157 @@
+"""
+Per-connection conversation state for SMS apps.
+
+Most apps start handling a message by looking up where the sender is in a conversation, a poll
+question or a registration flow for example.  Rather than each app querying its own models for
+this on every message, the router attaches a ConnectionState to every IncomingMessage as
+msg.state, which apps can read and write cheaply:
+
+    def handle(self, msg):
+        step = msg.state.get('registration_step', 0)
+        ...
+        msg.state.set('registration_step', step + 1)
+
+State is kept in an in-process LRU cache.  If ROUTER_STATE_BACKEND is set to 'redis', state is
+instead kept in a Redis hash per connection, so it is shared across processes and survives
+restarts.  In that case state is always read from Redis, as the next message in a conversation is
+usually handled by a different process.  Changes are only saved once the transaction the message is
+handled in commits, and only the keys which changed are written, so messages handled at the same
+time don't overwrite each other's changes.  Values must be JSON serializable.
+"""
+from django.conf import settings
+
+from threading import Lock
+import json
+
+from .utils import LRUCache, get_redis
+
+# the redis hash our state for each connection is stored in
+STATE_KEY = 'router_state:%d'
+
+# marks keys which were deleted in our pending changes
+DELETED = object()
+
+
+class ConnectionStateStore(object):
+    """
+    Stores conversation state by connection id, keeping track of how often we find it locally, or
+    how often we read it from Redis.
+    """
+    def __init__(self, after_commit=None):
+        self.after_commit = after_commit or (lambda save: save())
+        self.cache = LRUCache(getattr(settings, 'ROUTER_STATE_CACHE_SIZE', 10000))
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+        self.lock = Lock()
+
+    def use_redis(self):
+        return getattr(settings, 'ROUTER_STATE_BACKEND', 'local') == 'redis'
+
+    def get_ttl(self):
+        return getattr(settings, 'ROUTER_STATE_TTL', 60 * 60 * 24)
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_read(self):
+        with self.lock:
+            self.reads += 1
+
+    def load(self, connection_id):
+        """
+        Returns a copy of the state for the passed in connection id, an empty dict if it has none.
+        """
+        # state is never cached in front of Redis, as the next message in a conversation is usually
+        # handled by another process which may have changed it
+        if self.use_redis():
+            self.record_read()
+            values = get_redis().hgetall(STATE_KEY % connection_id)
+            return dict((key, json.loads(value)) for key, value in values.items())
+
+        state = self.cache.get(connection_id)
+        self.record(state is not None)
+
+        if state is None:
+            state = dict()
+            self.cache.set(connection_id, state, ttl=self.get_ttl())
+
+        return dict(state)
+
+    def save(self, connection_id, changes, cleared=False):
+        """
+        Saves the passed in changes to the state for the passed in connection id once our current
+        transaction commits.  Changes map keys to their new values, or DELETED for removed keys.
+        If cleared is set, all other keys are removed first.
+        """
+        changes = dict(changes)
+        self.after_commit(lambda: self.apply(connection_id, changes, cleared))
+
+    def apply(self, connection_id, changes, cleared):
+        if self.use_redis():
+            key = STATE_KEY % connection_id
+            pipe = get_redis().pipeline()
+            if cleared:
+                pipe.delete(key)
+
+            updated = dict((field, json.dumps(value)) for field, value in changes.items() if value is not DELETED)
+            deleted = [field for field, value in changes.items() if value is DELETED]
+            if updated:
+                pipe.hmset(key, updated)
+            if deleted:
+                pipe.hdel(key, *deleted)
+
+            pipe.expire(key, self.get_ttl())
+            pipe.execute()
+            return
+
+        with self.lock:
+            state = dict() if cleared else dict(self.cache.get(connection_id) or {})
+            for field, value in changes.items():
+                if value is DELETED:
+                    state.pop(field, None)
+                else:
+                    state[field] = value
+
+            self.cache.set(connection_id, state, ttl=self.get_ttl())
+
+    def for_connection(self, connection):
+        return ConnectionState(self, connection.pk)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, reads=self.reads, size=len(self.cache))
+
+
+class ConnectionState(object):
+    """
+    The conversation state of a single connection, loaded lazily the first time it is used.
+    """
+    def __init__(self, store, connection_id):
+        self.store = store
+        self.connection_id = connection_id
+        self.state = None
+
+    def load(self):
+        if self.state is None:
+            self.state = self.store.load(self.connection_id)
+        return self.state
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def set(self, key, value):
+        self.load()[key] = value
+        self.store.save(self.connection_id, {key: value})
+
+    def delete(self, key):
+        # the key may have been set by another message since we loaded our state, so always delete it
+        self.load().pop(key, None)
+        self.store.save(self.connection_id, {key: DELETED})
+
+    def clear(self):
+        self.state = dict()
+        self.store.save(self.connection_id, {}, cleared=True)
@@ -7,14 +7,33 @@ from urllib2 import urlopen
 import traceback
 import time
 import re
-import redis
 
 import logging
 logger = logging.getLogger(__name__)
 
 from .models import Message, DeliveryError, QUEUED, ERRORED, DISPATCHED, SENT, FAILED, OUTGOING, INCOMING
-from .router import HttpRouter
-from .textit import lookup_textit_backend_by_name, send_textit_message
+from .router import HttpRouter, get_router
+from .textit import lookup_textit_backend_by_name, send_textit_message, flush_status_events
+from .utils import get_redis
+from .budgets import query_budget
+from .replicas import use_primary
+from .sharding import use_shard, get_shards, get_shard_for_id
+from .circuit import breaker
+from .endpoints import endpoints, get_endpoints
+
+# how long we hold the lock on a message while sending it, and how long each request to an endpoint
+# can take.  We stop trying further endpoints once another request could run past our lock, with a
+# margin for saving the result, so that a resend can never take the lock and send it again
+SEND_LOCK_TIMEOUT = 60
+SEND_FETCH_TIMEOUT = 15
+SEND_SAVE_MARGIN = 10
+
+class MessageRejected(Exception):
+    """
+    Raised when a backend answers but refuses a message, which says nothing about whether the
+    backend is working, so doesn't count towards opening its circuit.
+    """
+    pass
 
 def fetch_url(url, params):
     if hasattr(settings, 'ROUTER_FETCH_URL'):
@@ -23,38 +42,27 @@ def fetch_url(url, params):
     else:
         return HttpRouter.fetch_url(url, params)
 
-def build_send_url(params, **kwargs):
+def quote_params(params, **kwargs):
     """
-    Constructs an appropriate send url for the given message.
+    URL encodes the passed in send parameters in place.
     """
-    # make sure our parameters are URL encoded
     params.update(kwargs)
     for k, v in params.items():
         try:
             params[k] = quote_plus(str(v))
         except UnicodeEncodeError:
             params[k] = quote_plus(str(v.encode('UTF-8')))
-            
-    # get our router URL
-    router_url = settings.ROUTER_URL
 
-    # is this actually a dict?  if so, we want to look up the appropriate backend
-    if type(router_url) is dict:
-        router_dict = router_url
-        backend_name = params['backend']
-            
-        # is there an entry for this backend?
-        if backend_name in router_dict:
-            router_url = router_dict[backend_name]
-
-        # if not, look for a default backend 
-        elif 'default' in router_dict:
-            router_url = router_dict['default']
+def build_send_url(params, router_url=None, **kwargs):
+    """
+    Constructs an appropriate send url for the given message, using the passed in router url or
+    the first endpoint configured for its backend.
+    """
+    # make sure our parameters are URL encoded
+    quote_params(params, **kwargs)
 
-        # none?  blow the hell up
-        else:
-            self.error("No router url mapping found for backend '%s', check your settings.ROUTER_URL setting" % backend_name)
-            raise Exception("No router url mapping found for backend '%s', check your settings.ROUTER_URL setting" % backend_name)
+    if router_url is None:
+        router_url = get_endpoints(params['backend'])[0][0]
 
     # return our built up url with all our variables substituted in
     full_url = router_url % params
@@ -65,6 +73,14 @@ def send_message(msg, **kwargs):
     Sends a message using its configured endpoint
     """
     msg_log = "Sending message: [%d]\n" % msg.id
+    backend = msg.connection.backend.name
+
+    # if this backend's circuit is open, park the message until the resend task picks it up again
+    if not breaker.allow(backend):
+        print "  [%d] - circuit for %s open, parking" % (msg.id, backend)
+        msg.status = QUEUED
+        msg.save(force_update=True)
+        return None
 
     print "[%d] >> %s\n" % (msg.id, msg.text)
 
@@ -79,7 +95,8 @@ def send_message(msg, **kwargs):
             if broadcast_id:
                 msg.external_id = broadcast_id
                 msg.status = DISPATCHED
-                msg.save()
+                msg.save(force_update=True)
+                breaker.record_success(backend)
                 return 200
             else:
                 # no ids back is almost certainly an error, we'll retry later
@@ -95,12 +112,39 @@ def send_message(msg, **kwargs):
                 'id': msg.pk
             }
 
-            url = build_send_url(params)
-            print "[%d] - %s\n" % (msg.id, url)
-            msg_log += "%s %s\n" % (msg.connection.backend.name, url)
-            
-            response = fetch_url(url, params)
-            status_code = response.getcode()
+            quote_params(params)
+
+            # try each of our backend's endpoints in turn until one accepts the message, or we run
+            # out of time before our lock lapses
+            deadline = time.time() + SEND_LOCK_TIMEOUT - SEND_SAVE_MARGIN
+            tried = []
+            while True:
+                router_url = endpoints.choose(backend, tried)
+                url = router_url % params
+                print "[%d] - %s\n" % (msg.id, url)
+                msg_log += "%s %s\n" % (msg.connection.backend.name, url)
+
+                try:
+                    with endpoints.sending(router_url):
+                        response = fetch_url(url, params)
+                        status_code = response.getcode()
+
+                    # client errors are down to the message, not the endpoint
+                    if int(status_code/100) == 5:
+                        raise Exception("Received status code: %d" % status_code)
+
+                    endpoints.mark_ok(router_url)
+                    break
+
+                except Exception as e:
+                    endpoints.mark_failed(router_url)
+                    tried.append(router_url)
+
+                    if len(tried) >= len(get_endpoints(backend)) or time.time() + SEND_FETCH_TIMEOUT > deadline:
+                        raise
+
+                    print "  [%d] - endpoint error - %s, trying next endpoint" % (msg.id, str(e))
+                    msg_log += "Error: %s, trying next endpoint\n" % str(e)
 
             body = response.read().decode('ascii', 'ignore').encode('ascii')
 
@@ -114,15 +158,22 @@ def send_message(msg, **kwargs):
                 logger.info("SMS[%d] SENT" % msg.id)
                 msg.sent = datetime.now()
                 msg.status = SENT
-                msg.save()
+                msg.save(force_update=True)
+                breaker.record_success(backend)
 
                 return status_code
             else:
-                raise Exception("Received status code: %d" % status_code)
+                # the backend is up, it just won't take this message
+                breaker.record_success(backend)
+                raise MessageRejected("Received status code: %d" % status_code)
 
     except Exception as e:
         print "  [%d] - send error - %s" % (msg.id, str(e))
 
+        # only server and connection errors count against the backend's circuit
+        if not isinstance(e, MessageRejected):
+            breaker.record_failure(backend)
+
         # previous errors
         previous_count = DeliveryError.objects.filter(message=msg).count()
         msg_log += "Failure #%d\n\n" % (previous_count+1)
@@ -131,11 +182,11 @@ def send_message(msg, **kwargs):
         if previous_count >= 2:
             msg_log += "Permanent failure, will not retry."
             msg.status = FAILED
-            msg.save()
+            msg.save(force_update=True)
         else:
             msg_log += "Will retry %d more time(s)." % (2 - previous_count)
             msg.status = ERRORED
-            msg.save()
+            msg.save(force_update=True)
 
         DeliveryError.objects.create(message=msg, log=msg_log)
 
@@ -146,21 +197,45 @@ def send_message_task(message_id):  #pragma: no cover
     # noop if there is no ROUTER_URL
     if not getattr(settings, 'ROUTER_URL', None):
         print "  [%d] - no ROUTER_URL configured, ignoring" % message_id
+        return
 
     # we use redis to acquire a global lock based on our settings key
-    r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    r = get_redis()
+    send_locked_message(r, message_id)
 
+@task(track_started=True)
+def send_messages_task(message_ids):  #pragma: no cover
+    # noop if there is no ROUTER_URL
+    if not getattr(settings, 'ROUTER_URL', None):
+        print "  [%d messages] - no ROUTER_URL configured, ignoring" % len(message_ids)
+        return
+
+    r = get_redis()
+    for message_id in message_ids:
+        send_locked_message(r, message_id)
+
+def send_locked_message(r, message_id):
+    """
+    Sends the message with the passed in id if it still needs sending, holding a lock on it in the
+    passed in redis connection while we do so.
+    """
     # try to acquire a lock, at most it will last 60 seconds
-    with r.lock('send_message_%d' % message_id, timeout=60):
+    with r.lock('send_message_%d' % message_id, timeout=SEND_LOCK_TIMEOUT):
         print "  [%d] - sending message" % message_id
 
-        # get the message
-        msg = Message.objects.get(pk=message_id)
+        with use_primary(), use_shard(get_shard_for_id(message_id)), query_budget('send_message'):
+            # get the message, along with the connection and backend we need to send it
+            msg = Message.objects.select_related('connection__backend').get(pk=message_id)
 
-        # if it hasn't been sent and it needs to be sent
-        if msg.status == QUEUED or msg.status == ERRORED:
-            status = send_message(msg)
-            print "  [%d] - msg sent status: %s" % (message_id, status)
+            # if it hasn't been sent and it needs to be sent
+            if msg.status == QUEUED or msg.status == ERRORED:
+                status = send_message(msg)
+                print "  [%d] - msg sent status: %s" % (message_id, status)
+
+@task(track_started=True)
+def handle_incoming_task(message_id):  #pragma: no cover
+    print "  [%d] - handling queued message" % message_id
+    get_router().handle_queued_incoming(message_id)
 
 @task(track_started=True)
 def resend_errored_messages_task():  #pragma: no cover
@@ -171,35 +246,54 @@ def resend_errored_messages_task():  #pragma: no cover
     print "-- resending errors --"
 
     # we use redis to acquire a global lock based on our settings key
-    r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    r = get_redis()
 
     # try to acquire a lock, at most it will last 5 mins
     with r.lock('resend_messages', timeout=300):
-        # get all errored outgoing messages
-        pending = Message.objects.filter(direction=OUTGOING, status__in=(ERRORED))
+        # messages are resent from every shard
+        for shard in get_shards() or [None]:
+            with use_shard(shard):
+                resend_messages(shard)
+
+def resend_messages(shard):
+    """
+    Resends up to 100 errored and 100 stuck queued messages from our current shard.
+    """
+    # get all errored outgoing messages
+    pending = Message.objects.filter(direction=OUTGOING, status__in=(ERRORED)).select_related('connection__backend')
 
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
+    # send each
+    count = 0
+    for msg in pending:
+        msg.send()
+        count+=1
 
-            if count >= 100: break
+        if count >= 100: break
 
-        print "-- resent %d errored messages --" % count
+    print "-- resent %d errored messages%s --" % (count, " on %s" % shard if shard else "")
 
-        # and all queued messages that are older than 2 minutes
-        three_minutes_ago = datetime.now() - timedelta(minutes=3)
-        pending = Message.objects.filter(direction=OUTGOING, status__in=(QUEUED), updated__lte=three_minutes_ago)
+    # and all queued messages that are older than 2 minutes
+    three_minutes_ago = datetime.now() - timedelta(minutes=3)
+    pending = Message.objects.filter(direction=OUTGOING, status__in=(QUEUED), updated__lte=three_minutes_ago).select_related('connection__backend')
 
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
+    # send each
+    count = 0
+    for msg in pending:
+        msg.send()
+        count+=1
 
-            if count >= 100: break
+        if count >= 100: break
 
-        print "-- resent %d pending messages -- " % count
+    print "-- resent %d pending messages%s -- " % (count, " on %s" % shard if shard else "")
 
+@task(track_started=True)
+def flush_textit_status_task():  #pragma: no cover
+    """
+    Applies any TextIt status events which have been buffered by our webhook.
+    """
+    r = get_redis()
 
+    # only one flusher at a time, otherwise we could apply statuses out of order
+    with r.lock('flush_textit_status', timeout=300):
+        count = flush_status_events()
+        print "-- applied %d textit status events --" % count
@@ -2,7 +2,7 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 from django.conf.urls.defaults import *
-from .views import receive, outbox, delivered, console, relaylog, alert, status
+from .views import receive, outbox, delivered, console, console_updates, relaylog, alert, status
 from .textit import textit_webhook
 from django.contrib.admin.views.decorators import staff_member_required
 
@@ -13,6 +13,7 @@ urlpatterns = patterns("",
    ("^router/relaylog", relaylog),
    ("^router/alert", alert),
    ("^router/delivered", delivered),
+   ("^router/console/updates", staff_member_required(console_updates), {}, 'httprouter-console-updates'),
    ("^router/console", staff_member_required(console), {}, 'httprouter-console'),
    ("^router/textit", textit_webhook),
 )
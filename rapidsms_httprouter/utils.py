@@ -0,0 +1,313 @@
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import AutoField, sql
+from django.utils import timezone
+
+from collections import OrderedDict, defaultdict
+from threading import Lock
+import datetime
+import math
+import time
+
+def get_redis():
+    """
+    Returns a connection to the Redis server configured in our settings.  Like Celery, our dependency
+    on Redis is a soft one, so we only import it when it is actually needed.
+    """
+    import redis
+    return redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+def get_queue_depth(queue):
+    """
+    Returns the number of tasks waiting in the passed in Celery queue, or None if we can't tell, say
+    because the queue doesn't exist yet.
+    """
+    from celery import current_app
+
+    try:
+        with current_app.connection() as connection:
+            name, depth, consumers = connection.default_channel.queue_declare(queue=queue, passive=True)
+            return depth
+    except Exception:
+        return None
+
+def iterate_chunks(queryset, fields, chunk_size=1000, start_id=0):
+    """
+    Iterates across the passed in queryset in chunks ordered by primary key, yielding lists of
+    value tuples for the passed in fields, the first of which must be the primary key.  Each chunk
+    is its own query starting after the last id we saw, so this can walk very large tables without
+    holding them in memory, and can be resumed by passing in a start_id.
+    """
+    last_id = start_id
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_id).order_by('pk').values_list(*fields)[:chunk_size])
+        if not chunk:
+            break
+
+        yield chunk
+
+        last_id = chunk[-1][0]
+        if len(chunk) < chunk_size:
+            break
+
+def get_id_before(model, field, value):
+    """
+    Returns the id of the last row of the passed in model whose field is before value, or 0 if there
+    are none.  This is a binary search on primary key, so it only takes a few dozen indexed lookups
+    however big the table is, letting us start keyset scans at a date without an index on it.  It
+    relies on field increasing along with id, as it does for the dates rows are created on.
+    """
+    rows = model.objects.order_by('pk').values_list('pk', field)
+    last = list(rows.order_by('-pk')[:1])
+    if not last:
+        return 0
+
+    low, high = 0, last[0][0]
+    while low < high:
+        middle = (low + high + 1) // 2
+        pk, row_value = rows.filter(pk__gte=middle)[0]
+        if row_value < value:
+            low = pk
+        else:
+            high = middle - 1
+
+    return low
+
+def can_return_ids(model):
+    """
+    Returns whether the database the passed in model is written to can return the ids of the rows
+    an insert creates, as PostgreSQL can.
+    """
+    return connections[router.db_for_write(model)].features.can_return_id_from_insert
+
+def bulk_create_returning_ids(model, objects):
+    """
+    Creates the passed in objects with a single insert as bulk_create does, but also sets the id of
+    each object from the ids returned by the insert.  Only call this if can_return_ids is True.
+    """
+    if not objects:
+        return objects
+
+    db = router.db_for_write(model)
+    connection = connections[db]
+
+    query = sql.InsertQuery(model)
+    query.insert_values([f for f in model._meta.local_fields if not isinstance(f, AutoField)], objects)
+    [(insert_sql, params)] = query.get_compiler(using=db).as_sql()
+
+    cursor = connection.cursor()
+    cursor.execute("%s RETURNING %s" % (insert_sql, connection.ops.quote_name(model._meta.pk.column)), params)
+    for obj, (pk,) in zip(objects, cursor.fetchall()):
+        obj.pk = pk
+
+    transaction.commit_unless_managed(using=db)
+    return objects
+
+def iterate_batches(iterable, batch_size):
+    """
+    Breaks the passed in iterable up into lists of at most batch_size items, without ever reading
+    more than a single batch of it into memory.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def release_connections():
+    """
+    Commits and closes our database connections, so that requests which block for a long time,
+    such as long polls, don't sit idle in a transaction holding a connection open.  Connections
+    whose transactions are being managed by someone else are left alone.  Django reopens them as
+    soon as they are used again.
+    """
+    for connection in connections.all():
+        if not transaction.is_managed(using=connection.alias):
+            transaction.commit_unless_managed(using=connection.alias)
+            connection.close()
+
+class QueryCounter(object):
+    """
+    Context manager which counts the SQL queries made against our databases while it is active,
+    even when DEBUG is off.  Queries against every database are counted, unless using is given.
+    Queries we only logged to count them are dropped again on exit, so connections don't collect
+    queries forever in long running processes like Celery workers, ie:
+
+        with QueryCounter() as counter:
+            router.handle_incoming('mtn', '250788123123', 'hello')
+
+        print counter.count, counter.time
+    """
+    def __init__(self, using=None):
+        self.using = using
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+
+    def __enter__(self):
+        aliases = [self.using] if self.using else list(connections)
+
+        # the connection, its previous debug cursor setting and its number of queries for each database
+        self.connections = []
+        for alias in aliases:
+            connection = connections[alias]
+            self.connections.append((connection, connection.use_debug_cursor, len(connection.queries)))
+            connection.use_debug_cursor = True
+
+        return self
+
+    def get_queries(self):
+        """
+        Returns the queries made so far.
+        """
+        return [query for connection, use_debug_cursor, start in self.connections
+                for query in connection.queries[start:]]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queries = self.get_queries()
+        self.count = len(self.queries)
+        self.time = sum(float(query['time']) for query in self.queries)
+
+        for connection, use_debug_cursor, start in self.connections:
+            connection.use_debug_cursor = use_debug_cursor
+
+            # if queries weren't being logged before us, forget the ones we logged
+            if not use_debug_cursor and not (use_debug_cursor is None and settings.DEBUG):
+                del connection.queries[start:]
+
+class LRUCache(object):
+    """
+    Simple thread safe in-process cache, holding at most max_size items.  When full, the least
+    recently used item is dropped.  Items can optionally expire after a number of seconds.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+
+            value, expires = item
+            if expires is not None and expires < time.time():
+                return default
+
+            # move this item to the end, making it our most recently used
+            self.items[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        self.items.pop(key, None)
+        self.items[key] = (value, expires)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """
+        Sets the passed in key only if it isn't already present, returning whether it was set.
+        """
+        with self.lock:
+            item = self.items.get(key, None)
+            if item is not None and (item[1] is None or item[1] >= time.time()):
+                return False
+
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+class StreamingHistogram(object):
+    """
+    Estimates percentiles of a stream of values in bounded memory.  Values are counted in buckets
+    whose widths grow logarithmically, so estimates are always within precision of the true value
+    and we only ever hold a few thousand counts, however many values we see.  ie:
+
+        histogram = StreamingHistogram()
+        for latency in latencies:
+            histogram.add(latency)
+
+        print histogram.percentile(99)
+    """
+    def __init__(self, precision=0.01, minimum=0.001):
+        self.precision = precision
+        self.minimum = minimum
+        self.log_base = math.log(1 + precision)
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        # values under our minimum, including negative ones from clock skew, all count as zero
+        if value < self.minimum:
+            bucket = -1
+        else:
+            bucket = int(math.log(value / self.minimum) / self.log_base)
+
+        self.buckets[bucket] += 1
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_value(self, bucket):
+        if bucket < 0:
+            return 0
+        return self.minimum * math.exp(self.log_base * bucket) * (1 + self.precision / 2)
+
+    def percentile(self, percent):
+        """
+        Returns our estimate of the value at the passed in percentile, None if we have seen no values.
+        """
+        if not self.count:
+            return None
+
+        rank = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.bucket_value(bucket), self.max)
+
+# the formats we accept for dates given to our management commands
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+def parse_datetime(value):
+    """
+    Parses a date given as YYYY-MM-DD [HH:MM[:SS]] in our default timezone, raising ValueError if
+    it isn't in any of those formats.
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+        if getattr(settings, 'USE_TZ', False):
+            date = timezone.make_aware(date, timezone.get_default_timezone())
+        return date
+
+    raise ValueError("Invalid date: %s" % value)
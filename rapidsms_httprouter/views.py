@@ -1,7 +1,7 @@
 import json
 
 from django import forms
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.template import RequestContext
 from django.shortcuts import render_to_response
 from django.conf import settings
@@ -20,6 +20,14 @@ import datetime
 
 from .models import Message
 from .router import get_router
+from .budgets import query_budget
+from .admission import Overloaded
+from .replicas import use_replica, use_primary
+from .profiling import profiled
+from .sharding import shard_querysets, get_shards, ShardedList
+from .circuit import breaker
+from .longpoll import OutboxListener, get_max_wait
+from .utils import release_connections
 
 class SecureForm(forms.Form):
     """
@@ -44,9 +52,14 @@ class MessageForm(SecureForm):
     message = forms.CharField(max_length=160, required=False)
     echo = forms.BooleanField(required=False)
 
+    # the id assigned to this message by the backend, used to detect retries
+    external_id = forms.CharField(max_length=64, required=False)
+
 class OutboxForm(SecureForm):
     backend = forms.CharField(max_length=32, required=False)
+    wait = forms.IntegerField(required=False, min_value=0)
 
+@profiled('receive')
 def receive(request):
     """
     Takes the passed in message.  Creates a record for it, and passes it through
@@ -61,12 +74,37 @@ def receive(request):
     # otherwise, create the message
     data = form.cleaned_data
     router = get_router()
-    message = router.handle_incoming(data['backend'], data['sender'], data['message'])
+    queued = False
+
+    try:
+        with router.admission.slot(data['backend']):
+            message, duplicate = router.handle_incoming_once(data['backend'], data['sender'], data['message'],
+                                                             data['external_id'])
+
+    # we are too busy to handle this message now, either queue it or tell our backend to retry later
+    except Overloaded:
+        if not router.admission.should_queue():
+            response = HttpResponse("Too busy, try again later.", status=503)
+            response['Retry-After'] = str(router.admission.get_retry_after())
+            return response
+
+        message, duplicate = router.queue_incoming_once(data['backend'], data['sender'], data['message'],
+                                                        data['external_id'])
+        queued = not duplicate
 
     response = {}
-    response['message'] = message.as_json()
-    response['responses'] = [m.as_json() for m in message.responses.all()]
-    response['status'] = "Message handled."
+    if message:
+        response['message'] = message.as_json()
+        response['responses'] = [m.as_json() for m in message.responses.select_related('connection__backend')]
+
+    if queued:
+        response['status'] = "Message queued."
+    elif not duplicate:
+        response['status'] = "Message handled."
+    elif message:
+        response['status'] = "Message already handled."
+    else:
+        response['status'] = "Message already being handled."
 
     # do we default to having silent responses?  200 means success in this case
     if getattr(settings, "ROUTER_SILENT", False) and (not 'echo' in data or not data['echo']):
@@ -115,35 +153,110 @@ def alert(request):
         return HttpResponse("Must be POST containing subject, body and password params", status=400)
 
 
+@query_budget('outbox')
+def get_outbox(backend=None):
+    """
+    Returns the messages in the outbox as json, for all backends or just the one passed in.
+    """
+    # send our most urgent messages first
+    pending_messages = Message.objects.filter(status='Q').select_related('connection__backend').order_by('-priority', 'id')
+    if backend:
+        pending_messages = pending_messages.filter(connection__backend__name__iexact=backend)
+
+    messages = []
+    for shard_messages in shard_querysets(pending_messages):
+        messages.extend(shard_messages)
+
+    # each shard is in order, but their messages need merging so urgent ones go first whatever shard they're on
+    if len(messages) > 1 and get_shards():
+        messages.sort(key=lambda message: (-message.priority, message.id))
+
+    return [message.as_json() for message in messages]
+
+@profiled('outbox')
+@use_replica()
 def outbox(request):
     """
     Returns any messages which have been queued to be sent but have no yet been marked
-    as being delivered.
+    as being delivered.  If the outbox is empty and a wait is passed in, waits up to that
+    many seconds for a message to be queued.
     """
     form = OutboxForm(request.GET)
     if not form.is_valid():
         return HttpResponse(str(form.errors), status=400)
 
     data = form.cleaned_data
-    pending_messages = Message.objects.filter(status='Q')
-    if 'backend' in data and data['backend']:
-        pending_messages = pending_messages.filter(connection__backend__name__iexact=data['backend'])
+    backend = data.get('backend', None)
+    messages = get_outbox(backend)
+
+    wait = min(data.get('wait', None) or 0, get_max_wait())
+    if not messages and wait:
+        # new messages may not have reached our replica yet
+        with use_primary(), OutboxListener(backend) as listener:
+            # check again now we are listening, in case a message was queued in between
+            messages = get_outbox(backend)
+            if not messages:
+                # don't hold on to our database connections while we wait, only query again once woken
+                release_connections()
+                if listener.wait(wait):
+                    messages = get_outbox(backend)
 
     response = {}
-    messages = []
-    for message in pending_messages:
-        messages.append(message.as_json())
-
     response['outbox'] = messages
     response['status'] = "Outbox follows."
 
     return HttpResponse(json.dumps(response))
 
 
+class ConsoleUpdatesForm(forms.Form):
+    since_id = forms.IntegerField(required=False, min_value=0)
+
+
+# the most messages we'll return to the console in a single poll
+CONSOLE_UPDATES_LIMIT = 100
+
+@use_replica()
+def console_updates(request):
+    """
+    Returns any messages newer than the passed in since_id as json, this lets the console append
+    new traffic without reloading the whole page.  Supports conditional requests using an ETag
+    based on the newest message id, so idle consoles only cost a single indexed lookup.
+
+    Only new messages are streamed in, changes to the status of messages the console already shows,
+    such as replies being sent or delivered, don't change our ETag and only show up on reload.
+    Tracking those would mean scanning the unindexed updated column on every poll.
+    """
+    form = ConsoleUpdatesForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    since_id = form.cleaned_data['since_id'] or 0
+
+    # find the newest message id, if that hasn't moved then nothing has changed
+    last_id = Message.objects.order_by('-id').values_list('id', flat=True)[:1]
+    last_id = last_id[0] if last_id else 0
+    etag = '"%d"' % last_id
+
+    messages = []
+    if since_id < last_id:
+        new_messages = Message.objects.filter(id__gt=since_id).select_related('connection__backend').order_by('id')
+        messages = [message.as_json() for message in new_messages[:CONSOLE_UPDATES_LIMIT]]
+
+    elif request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    response = HttpResponse(json.dumps(dict(messages=messages, last_id=last_id)), content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
 class DeliveredForm(SecureForm):
     message_id = forms.IntegerField()
 
 
+@profiled('delivered')
 def delivered(request):
     """
     Called when a message is delivered by our backend.
@@ -183,16 +296,27 @@ class ReplyForm(forms.Form):
 class SearchForm(forms.Form):
     search = forms.CharField(label="Keywords", max_length=100, widget=forms.TextInput(attrs={'size': '60'}), required=False)
 
+@use_replica()
 def status(request):
     """
     Simple view suitable for automated monitoring, will output how many messages have been pending to send for a
     while.
     """
     fifteen_minutes_ago = timezone.now() - datetime.timedelta(minutes=15)
-    pending_count = Message.objects.filter(status='Q', date__lte=fifteen_minutes_ago).count()
+    pending_count = sum(messages.count() for messages in
+                        shard_querysets(Message.objects.filter(status='Q', date__lte=fifteen_minutes_ago)))
+
+    router = get_router()
+    state = router.state.stats()
+    admission = router.admission.stats()
+    apps = router.app_budgets.stats()
+    circuits = breaker.stats()
 
-    return render_to_response("router/status.html", dict(pending_count=pending_count),context_instance=RequestContext(request))
+    return render_to_response("router/status.html", dict(pending_count=pending_count, state=state, admission=admission,
+                                                         apps=apps, circuits=circuits),
+                              context_instance=RequestContext(request))
 
+@use_replica()
 def console(request):
     """
     Our web console, lets you see recent messages as well as send out new ones for
@@ -217,9 +341,13 @@ def console(request):
         elif request.REQUEST['action'] == 'reply':
             reply_form = ReplyForm(request.POST)
             if reply_form.is_valid():
-                if Connection.objects.filter(identity=reply_form.cleaned_data['recipient']).count():
+                # our recipient could be on any of our shards
+                connections = [connection for connections in
+                               shard_querysets(Connection.objects.filter(identity=reply_form.cleaned_data['recipient']))
+                               for connection in connections[:1]]
+                if connections:
                     text = reply_form.cleaned_data['message']
-                    conn = Connection.objects.filter(identity=reply_form.cleaned_data['recipient'])[0]
+                    conn = connections[0]
                     outgoing = OutgoingMessage(conn, text)
                     get_router().handle_outgoing(outgoing)
                 else:
@@ -240,7 +368,13 @@ def console(request):
 
                 queryset = queryset.filter(query)
 
-    paginator = Paginator(queryset.order_by('-id'), 20)
+    # when sharding, we merge the messages from every shard
+    if get_shards():
+        queryset = ShardedList(shard_querysets(queryset))
+    else:
+        queryset = queryset.order_by('-id')
+
+    paginator = Paginator(queryset, 20)
     page = request.REQUEST.get('page')
     try:
         messages = paginator.page(page)
@@ -251,12 +385,22 @@ def console(request):
         # None or not an integer, default to first page
         messages = paginator.page(1)
 
+    # only stream new messages into the first page of an unfiltered console, ids aren't ordered across shards
+    # so we can't tell which messages are new when sharding
+    live_updates = messages.number == 1 and request.REQUEST.get('action', None) != 'search' and not get_shards()
+
+    # evaluate our page once, so checking for and reading its first message doesn't query it twice
+    messages.object_list = list(messages.object_list)
+    last_id = messages.object_list[0].id if messages.object_list else 0
+
     return render_to_response(
         "router/index.html", {
             "messages_table": MessageTable(queryset, request=request),
             "form": form,
             "reply_form": reply_form,
             "search_form": search_form,
-            "sms_messages": messages
+            "sms_messages": messages,
+            "live_updates": live_updates,
+            "last_id": last_id,
         }, context_instance=RequestContext(request)
     )
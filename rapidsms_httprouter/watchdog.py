@@ -0,0 +1,146 @@
+"""
+Time budgets for SMS apps.
+
+A single slow app, say one making an HTTP request in handle(), holds up every message it sees
+along with the web worker handling it.  The router times every app in every incoming phase
+against the budgets below, logging and counting any overruns:
+
+    ROUTER_APP_BUDGETS = {
+        'default': 2,                           # seconds any app may spend in a phase
+        'polls': 5,                             # by app name
+        'registration': {'handle': 10, 'default': 1},   # or by app name and phase
+    }
+    ROUTER_MESSAGE_BUDGET = 10                  # seconds all apps may spend on a message
+    ROUTER_BUDGET_ACTION = 'skip'               # skip the remaining apps once a message is over budget
+
+By default overruns are only logged.  When ROUTER_BUDGET_ACTION is 'skip', once a message has used
+up its budget the remaining apps and phases are skipped.  Budgets are checked between apps, so to
+also interrupt an app which is running over, set ROUTER_APP_WATCHDOG = True.  The watchdog uses
+SIGALRM, so it only works on Unix when messages are handled in the main thread, as they are with
+most pre-forking servers.  Interrupted apps see an AppTimeout exception, which is handled like any
+other app exception.  Messages handled in any other thread, such as by threaded servers or our
+background handler, fall back to only logging overruns, and a warning is logged the first time.
+"""
+from django.conf import settings
+
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, current_thread, _MainThread
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AppTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise AppTimeout("App ran past its time budget")
+
+
+class AppBudgets(object):
+    """
+    Times our apps against their budgets, keeping count of overruns by app.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.overruns = defaultdict(int)
+        self.skipped = 0
+        self.interrupted = 0
+        self.warned = False
+
+    def get_app_budget(self, app, phase):
+        budgets = getattr(settings, 'ROUTER_APP_BUDGETS', None)
+        if not budgets:
+            return None
+
+        budget = budgets.get(app.name, budgets.get('%s.%s' % (app.__module__, app.__class__.__name__), None))
+        if isinstance(budget, dict):
+            budget = budget.get(phase, budget.get('default', None))
+
+        if budget is None:
+            budget = budgets.get('default', None)
+
+        return budget
+
+    def get_message_budget(self):
+        return getattr(settings, 'ROUTER_MESSAGE_BUDGET', None)
+
+    def should_skip(self):
+        return getattr(settings, 'ROUTER_BUDGET_ACTION', 'log') == 'skip'
+
+    def use_watchdog(self):
+        if not getattr(settings, 'ROUTER_APP_WATCHDOG', False) or not hasattr(signal, 'setitimer'):
+            return False
+
+        # signals are only delivered to our main thread, anywhere else we can only log overruns
+        if not isinstance(current_thread(), _MainThread):
+            if not self.warned:
+                self.warned = True
+                logger.warning("App watchdog disabled outside the main thread, overruns will only be logged")
+            return False
+
+        return True
+
+    def get_remaining(self, start):
+        """
+        Returns how many seconds are left in the budget of a message whose apps started at start,
+        None if messages have no budget.
+        """
+        budget = self.get_message_budget()
+        if budget is None:
+            return None
+        return budget - (time.time() - start)
+
+    def is_exhausted(self, start):
+        remaining = self.get_remaining(start)
+        if remaining is not None and remaining <= 0 and self.should_skip():
+            with self.lock:
+                self.skipped += 1
+            return True
+        return False
+
+    @contextmanager
+    def timed(self, app, phase, remaining=None):
+        """
+        Times the wrapped call to the passed in app and phase, recording it if it runs over budget.
+        If our watchdog is enabled, the call is interrupted once it uses up its own budget or what
+        remains of the message's.
+        """
+        budget = self.get_app_budget(app, phase)
+
+        # the message's budget only cuts apps short when we skip apps over it
+        limits = [limit for limit in (budget, remaining if self.should_skip() else None) if limit is not None]
+        watchdog = limits and self.use_watchdog()
+        if watchdog:
+            previous = signal.signal(signal.SIGALRM, raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, max(min(limits), 0.001))
+
+        start = time.time()
+        try:
+            yield
+        except AppTimeout:
+            with self.lock:
+                self.interrupted += 1
+            raise
+        finally:
+            if watchdog:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+
+            elapsed = time.time() - start
+            if budget is not None and elapsed > budget:
+                self.record_overrun(app, phase, elapsed, budget)
+
+    def record_overrun(self, app, phase, elapsed, budget):
+        with self.lock:
+            self.overruns[app.name] += 1
+
+        logger.warning("App %s took %.3fs in %s phase, over its budget of %.3fs" % (app.name, elapsed, phase, budget))
+
+    def stats(self):
+        return dict(overruns=sum(self.overruns.values()), skipped=self.skipped, interrupted=self.interrupted,
+                    overruns_by_app=dict(self.overruns))